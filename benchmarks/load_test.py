@@ -0,0 +1,515 @@
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import apihelper, types
+
+import nvs_TicTacToeBOT as core
+
+
+# بار واقعی روی هندلرهای هسته، با یک Bot API ساختگی روی localhost به‌جای تلگرام
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+PLAYER_BASE_ID = 10_000_000
+MOVE_ANSWERS = ("حرکت ثبت شد.", "بازی تمام شد.", "مساوی شد.")
+GAME_OVER_ANSWERS = ("بازی تمام شد.", "مساوی شد.")
+RATE_LIMITED_METHODS = ("sendMessage", "editMessageText")
+
+
+class _Chat:
+    __slots__ = ("cond", "sent", "content")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.sent: List[Tuple[int, str, Optional[str]]] = []
+        self.content: Dict[int, Tuple[str, Optional[str]]] = {}
+
+
+class FakeBotApi:
+    # getMe، getChat، sendMessage، editMessageText و answerCallbackQuery با تأخیر و 429 قابل تنظیم
+    def __init__(self, seed: int, latency_ms: float, jitter_ms: float, rate_limit_share: float, retry_after: int):
+        self.seed = seed
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.calls: Dict[str, int] = {}
+        self.rate_limited = 0
+        self._chats: Dict[int, _Chat] = {}
+        self._answers: Dict[str, Tuple[threading.Event, list]] = {}
+        self._draws: Dict[Tuple[str, int], int] = {}
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-api", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def chat(self, chat_id: int) -> _Chat:
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat()
+            return chat
+
+    def expect_answer(self, callback_id: str) -> Tuple[threading.Event, list]:
+        waiter = (threading.Event(), [])
+        with self._lock:
+            self._answers[callback_id] = waiter
+        return waiter
+
+    def _draw(self, method: str, chat_id: int) -> float:
+        # قرعه هر (متد، چت) از روی seed و شمارنده خودش؛ مستقل از ترتیب نخ‌ها
+        with self._lock:
+            n = self._draws.get((method, chat_id), 0)
+            self._draws[(method, chat_id)] = n + 1
+        return zlib.crc32(f"{self.seed}:{method}:{chat_id}:{n}".encode()) / 0xFFFFFFFF
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._serve()
+
+            def do_POST(self):
+                self._serve()
+
+            def _serve(self):
+                received = time.perf_counter()
+                parts = urlsplit(self.path)
+                params = dict(parse_qsl(parts.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    params.update(parse_qsl(self.rfile.read(length).decode()))
+                status, body = api.call(parts.path.rsplit("/", 1)[-1], params, received)
+                raw = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def call(self, method: str, params: Dict[str, str], received: float) -> Tuple[int, dict]:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params.get("chat_id") or 0)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.jitter * self._draw("latency", chat_id))
+        if method in RATE_LIMITED_METHODS and self.rate_limit_share and self._draw(method, chat_id) < self.rate_limit_share:
+            with self._lock:
+                self.rate_limited += 1
+            return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "getChat":
+            return 200, {"ok": True, "result": {"id": chat_id, "type": "private", "first_name": f"p{chat_id}", "username": f"p{chat_id}"}}
+        if method == "answerCallbackQuery":
+            with self._lock:
+                waiter = self._answers.pop(params.get("callback_query_id"), None)
+            if waiter is not None:
+                waiter[1].append((received, params.get("text") or ""))
+                waiter[0].set()
+            return 200, {"ok": True, "result": True}
+        if method in ("sendMessage", "editMessageText"):
+            return 200, {"ok": True, "result": self._store(method, chat_id, params)}
+        return 404, {"ok": False, "error_code": 404, "description": f"Not Found: method {method} not implemented"}
+
+    def _store(self, method: str, chat_id: int, params: Dict[str, str]) -> dict:
+        text, markup = params.get("text", ""), params.get("reply_markup")
+        chat = self.chat(chat_id)
+        with chat.cond:
+            if method == "sendMessage":
+                with self._lock:
+                    self._message_id += 1
+                    message_id = self._message_id
+                chat.sent.append((message_id, text, markup))
+            else:
+                message_id = int(params.get("message_id") or 0)
+            chat.content[message_id] = (text, markup)
+            chat.cond.notify_all()
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                   "from": BOT_USER, "text": text}
+        if markup:
+            message["reply_markup"] = json.loads(markup)
+        return message
+
+
+def board_cells(markup: Optional[str]) -> List[str]:
+    if not markup:
+        return []
+    rows = json.loads(markup).get("inline_keyboard", [])[:3]
+    cells = []
+    for row in rows:
+        for button in row:
+            label = button.get("text")
+            cells.append("X" if label == core.EMOJI_X else "O" if label == core.EMOJI_O else "")
+    return cells
+
+
+class Player:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"p{user_id}", "username": f"p{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+
+
+class LoadStats:
+    def __init__(self):
+        self.move_latencies: List[float] = []
+        self.moves = 0
+        self.games = 0
+        self.timeouts = 0
+        self.unexpected: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def answer(self, text: str):
+        with self._lock:
+            self.unexpected[text] = self.unexpected.get(text, 0) + 1
+
+    def move(self, latency: float):
+        with self._lock:
+            self.moves += 1
+            self.move_latencies.append(latency)
+
+
+class GameDriver:
+    # یک بازی کامل با کلیک‌های واقعی: /play، انتخاب حالت، پیوستن یا سختی AI، حرکت‌ها و گاهی رفرش
+    def __init__(self, api: FakeBotApi, stats: LoadStats, rng: random.Random, players: List[Player], args):
+        self.api = api
+        self.stats = stats
+        self.rng = rng
+        self.players = players
+        self.args = args
+        self._update_id = 0
+
+    def _next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _dispatch(self, update: dict):
+        core.bot.process_new_updates([types.Update.de_json(update)])
+
+    def command(self, player: Player, text: str):
+        command = text.split()[0]
+        self._dispatch({"update_id": self._next_id(), "message": {
+            "message_id": self._next_id(), "date": int(time.time()), "chat": player.chat, "from": player.user, "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}})
+
+    def click(self, player: Player, message_id: int, data: str) -> Optional[Tuple[float, str]]:
+        callback_id = f"{player.user_id}:{self._next_id()}"
+        event, answer = self.api.expect_answer(callback_id)
+        start = time.perf_counter()
+        self._dispatch({"update_id": self._next_id(), "callback_query": {
+            "id": callback_id, "from": player.user, "chat_instance": str(player.user_id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": player.chat, "from": BOT_USER, "text": "board"}}})
+        if not event.wait(self.args.timeout):
+            self.stats.add("timeouts")
+            return None
+        received, text = answer[0]
+        return received - start, text
+
+    def wait_sent(self, player: Player, seen: int, match: Callable[[str, Optional[str]], bool]) -> Optional[int]:
+        chat = self.api.chat(player.user_id)
+        end = time.monotonic() + self.args.timeout
+        with chat.cond:
+            while True:
+                for message_id, text, markup in chat.sent[seen:]:
+                    if match(text, markup):
+                        return message_id
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    self.stats.add("timeouts")
+                    return None
+                chat.cond.wait(remaining)
+
+    def wait_content(self, player: Player, message_id: int, match: Callable[[str, Optional[str]], bool]) -> Optional[Tuple[str, Optional[str]]]:
+        chat = self.api.chat(player.user_id)
+        end = time.monotonic() + self.args.timeout
+        with chat.cond:
+            while True:
+                content = chat.content.get(message_id)
+                if content is not None and match(*content):
+                    return content
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    self.stats.add("timeouts")
+                    return None
+                chat.cond.wait(remaining)
+
+    def think(self):
+        if self.args.think_ms:
+            time.sleep(self.rng.expovariate(1000 / self.args.think_ms))
+
+    def new_game(self, creator: Player) -> Optional[Tuple[str, int]]:
+        seen = len(self.api.chat(creator.user_id).sent)
+        self.command(creator, "/play")
+        menu = self.wait_sent(creator, seen, lambda text, markup: bool(markup) and "mode_pvp|" in markup)
+        if menu is None:
+            return None
+        markup = self.api.chat(creator.user_id).content[menu][1]
+        gid = re.search(r"mode_pvp\|(\w+)", markup).group(1)
+        return gid, menu
+
+    def move(self, player: Player, message_id: int, gid: str, pos: int) -> Optional[str]:
+        clicked = self.click(player, message_id, f"move_{gid}|{pos}")
+        if clicked is None:
+            return None
+        latency, text = clicked
+        if text not in MOVE_ANSWERS:
+            self.stats.answer(text)
+            return None
+        self.stats.move(latency)
+        return text
+
+    def maybe_refresh(self, player: Player, message_id: int, gid: str):
+        if self.rng.random() < self.args.refresh_share:
+            self.click(player, message_id, f"refresh_{gid}")
+
+    def play_pvp(self):
+        x, o = self.players
+        created = self.new_game(x)
+        if created is None:
+            return
+        gid, x_board = created
+        self.think()
+        if self.click(x, x_board, f"mode_pvp|{gid}") is None:
+            return
+        seen = len(self.api.chat(o.user_id).sent)
+        self.think()
+        self.command(o, f"/start join_{gid}")
+        o_board = self.wait_sent(o, seen, lambda text, markup: bool(markup) and "move_" in markup)
+        if o_board is None:
+            return
+        boards = {"X": (x, x_board), "O": (o, o_board)}
+        cells = [""] * 9
+        turn = "X"
+        while True:
+            player, message_id = boards[turn]
+            self.think()
+            self.maybe_refresh(player, message_id, gid)
+            pos = self.rng.choice([i for i in range(9) if not cells[i]])
+            answer = self.move(player, message_id, gid, pos)
+            if answer is None or answer in GAME_OVER_ANSWERS:
+                break
+            cells[pos] = turn
+            turn = "O" if turn == "X" else "X"
+        self.stats.add("games")
+
+    def play_ai(self):
+        x, = self.players
+        created = self.new_game(x)
+        if created is None:
+            return
+        gid, board = created
+        self.think()
+        if self.click(x, board, f"mode_ai|{gid}") is None:
+            return
+        self.think()
+        if self.click(x, board, f"diff_{self.rng.choice(self.args.difficulties)}|{gid}") is None:
+            return
+
+        played = 0
+
+        def my_turn(text: str, markup: Optional[str]) -> bool:
+            # بورد باید حرکت قبلی خودمان و جواب AI را نشان دهد، نه ویرایش قدیمی که هنوز در صف بوده
+            cells = board_cells(markup)
+            return "برنده" in text or "مساوی" in text or (
+                len(cells) == 9 and "نوبت: بازیکن X" in text and cells.count("X") == cells.count("O") == played)
+
+        while True:
+            content = self.wait_content(x, board, my_turn)
+            if content is None:
+                break
+            text, markup = content
+            cells = board_cells(markup)
+            empty = [i for i in range(9) if not cells[i]]
+            if "برنده" in text or "مساوی" in text or not empty:
+                break
+            self.think()
+            self.maybe_refresh(x, board, gid)
+            answer = self.move(x, board, gid, self.rng.choice(empty))
+            if answer is None or answer in GAME_OVER_ANSWERS:
+                break
+            played += 1
+        self.stats.add("games")
+
+    def run(self):
+        for _ in range(self.args.rounds):
+            if len(self.players) == 2:
+                self.play_pvp()
+            else:
+                self.play_ai()
+
+
+class ThreadSampler:
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self.peak_groups: Dict[str, int] = {}
+        self._stop = threading.Event()
+
+    @staticmethod
+    def groups() -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for t in threading.enumerate():
+            name = re.sub(r"[-_]?\d+.*$", "", t.name) or t.name
+            counts[name] = counts.get(name, 0) + 1
+        return dict(sorted(counts.items()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            groups = self.groups()
+            total = sum(groups.values())
+            if total > self.peak:
+                self.peak, self.peak_groups = total, groups
+
+    def start(self):
+        threading.Thread(target=self._run, name="sampler", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build_drivers(api: FakeBotApi, stats: LoadStats, args) -> List[GameDriver]:
+    rng = random.Random(args.seed)
+    players = [Player(PLAYER_BASE_ID + i) for i in range(args.players)]
+    rng.shuffle(players)
+    ai_players = int(round(args.players * args.ai_share))
+    groups = [[p] for p in players[:ai_players]]
+    rest = players[ai_players:]
+    groups += [rest[i:i + 2] for i in range(0, len(rest) - 1, 2)]
+    return [GameDriver(api, stats, random.Random(f"{args.seed}:{i}"), group, args) for i, group in enumerate(groups)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the real handlers against a local fake Bot API and report latency and costs")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--ai-share", type=float, default=0.2, help="share of players that play against the AI")
+    parser.add_argument("--difficulties", default="easy,medium,hard")
+    parser.add_argument("--rounds", type=int, default=1, help="games each driver plays back to back")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--think-ms", type=float, default=300.0, help="mean pause between a player's clicks")
+    parser.add_argument("--ramp-s", type=float, default=2.0, help="drivers start spread over this many seconds")
+    parser.add_argument("--refresh-share", type=float, default=0.05, help="chance of a refresh click before a move")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0)
+    parser.add_argument("--api-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--rate-limit-share", type=float, default=0.0, help="share of send/edit calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--keep-db", action="store_true", help="keep the temporary database directory")
+    args = parser.parse_args()
+    args.difficulties = [d for d in args.difficulties.split(",") if d]
+    # کلیک‌های هر بازی از seed خودش می‌آیند؛ AI از random سراسری برمی‌دارد که ترتیبش به زمان‌بندی نخ‌ها بسته است
+    random.seed(args.seed)
+
+    api = FakeBotApi(args.seed, args.api_latency_ms, args.api_jitter_ms, args.rate_limit_share, args.retry_after)
+    api.start()
+    apihelper.API_URL = api.url
+    workdir = tempfile.mkdtemp(prefix="nvs-load-")
+    core.DB_POOL.path = os.path.join(workdir, "load.db")
+    core.bot.threaded = False
+    core.start_runtime()
+
+    stats = LoadStats()
+    drivers = build_drivers(api, stats, args)
+    sampler = ThreadSampler()
+    sampler.start()
+    batches, writes = core.WRITES.batches, core.WRITES.writes
+    threads = []
+    start = time.perf_counter()
+    for i, driver in enumerate(drivers):
+        delay = args.ramp_s * i / max(1, len(drivers))
+        t = threading.Thread(target=lambda d=driver, delay=delay: (time.sleep(delay), d.run()), name=f"player-{i}", daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    played = time.perf_counter() - start
+    # انیمیشن‌های پایان بازی و صف خروجی هم جزو هزینه حرکت‌ها حساب می‌شوند
+    end = time.monotonic() + args.timeout
+    while core.ANIMATIONS.active and time.monotonic() < end:
+        time.sleep(0.05)
+    core.OUTBOX.wait_idle(max(0.0, end - time.monotonic()))
+    core.WRITES.sync()
+    sampler.stop()
+
+    moves = stats.moves or 1
+    calls = sum(api.calls.values())
+    report = {
+        "seed": args.seed,
+        "players": args.players,
+        "games": stats.games,
+        "moves": stats.moves,
+        "seconds": round(played, 3),
+        "moves_per_second": round(stats.moves / played, 1) if played else 0.0,
+        "move_p50_ms": round(percentile(stats.move_latencies, 0.50) * 1000, 3),
+        "move_p95_ms": round(percentile(stats.move_latencies, 0.95) * 1000, 3),
+        "move_p99_ms": round(percentile(stats.move_latencies, 0.99) * 1000, 3),
+        "telegram_calls": dict(sorted(api.calls.items())),
+        "telegram_calls_per_move": round(calls / moves, 3),
+        "telegram_429": api.rate_limited,
+        "db_transactions_per_move": round((core.WRITES.batches - batches) / moves, 3),
+        "db_writes_per_move": round((core.WRITES.writes - writes) / moves, 3),
+        "outbox": {"sent": core.OUTBOX.sent, "coalesced": core.OUTBOX.coalesced, "unchanged": core.OUTBOX.unchanged,
+                   "rate_limited": core.OUTBOX.rate_limited, "failed": core.OUTBOX.failed},
+        "animation_frames_skipped": core.ANIMATIONS.skipped,
+        "threads_peak": sampler.peak,
+        "threads_peak_by_name": sampler.peak_groups,
+        "threads_end": threading.active_count(),
+        "timeouts": stats.timeouts,
+        "unexpected_answers": stats.unexpected,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    api.stop()
+    core.flush_games()
+    if args.keep_db:
+        print(f"database kept in {workdir}")
+    else:
+        core.DB_POOL.close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
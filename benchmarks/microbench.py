@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import types
+
+import nvs_TicTacToeBOT as core
+
+
+# زمان و تخصیص حافظه مسیرهای داغ هر کلیک؛ خروجی JSON برای مقایسه بین کامیت‌ها
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_THRESHOLDS = os.path.join(HERE, "microbench_thresholds.json")
+PLAYER_X = 10_000_001
+PLAYER_O = 10_000_002
+ALLOC_CALLS = 50
+
+
+def positions(seed: int, count: int) -> List[core.Bitboard]:
+    # موقعیت‌های واقعی: از صفحه خالی تا آخر بازی، فقط صفحه‌هایی که هنوز تمام نشده‌اند
+    rng = random.Random(seed)
+    boards = [core.Bitboard()]
+    while len(boards) < count:
+        bb = core.Bitboard()
+        turn = "X"
+        for _ in range(rng.randrange(1, 8)):
+            bb.play(rng.choice(bb.legal_moves()), turn)
+            if core.check_winner(bb) or bb.is_full():
+                break
+            turn = "O" if turn == "X" else "X"
+        else:
+            if turn == "O":
+                boards.append(bb)
+    return boards
+
+
+def finished_positions(seed: int, count: int) -> List[core.Bitboard]:
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        bb = core.Bitboard()
+        turn = "X"
+        while not core.check_winner(bb) and not bb.is_full():
+            bb.play(rng.choice(bb.legal_moves()), turn)
+            turn = "O" if turn == "X" else "X"
+        boards.append(bb)
+    return boards
+
+
+def played_state(seed: int, plies: int, game_id: str = "bench00000001") -> core.GameState:
+    rng = random.Random(seed)
+    state = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=game_id)
+    state.set_message("X", PLAYER_X, 1001)
+    state.set_message("O", PLAYER_O, 1002)
+    ts = 1_700_000_000
+    for _ in range(plies):
+        pos = rng.choice(state.board.legal_moves())
+        state.play(pos, state.current_player, ts)
+        state.current_player = "O" if state.current_player == "X" else "X"
+        ts += rng.randrange(1, 20)
+    return state
+
+
+def legacy_dict(state: core.GameState) -> Dict:
+    # همان شکل state_json قدیمی که هنوز برای ردیف‌های نسخه ۰ خوانده می‌شود
+    return {
+        "board": state.board.to_list(),
+        "current_player": state.current_player,
+        "game_type": state.game_type,
+        "players": {"X": state.player_x, "O": state.player_o},
+        "ai_difficulty": state.ai_difficulty,
+        "history": [{"player": p, "pos": pos, "time": ts} for _, _, p, pos, ts in state.move_rows()],
+        "finished": state.finished,
+        "winner": state.winner,
+        "messages": {side: {"chat_id": c, "message_id": m} for side, (c, m) in
+                     (("X", state.message_x), ("O", state.message_o)) if c},
+    }
+
+
+def cycling(items: List) -> Callable[[], object]:
+    index = [0]
+
+    def next_item():
+        i = index[0]
+        index[0] = (i + 1) % len(items)
+        return items[i]
+    return next_item
+
+
+def engine_cases(seed: int) -> Dict[str, Callable[[], object]]:
+    midgame = cycling(positions(seed, 64))
+    finished = cycling(finished_positions(seed, 64))
+    mixed = cycling(positions(seed, 32) + finished_positions(seed + 1, 32))
+    as_lists = cycling([bb.to_list() for bb in positions(seed, 32)])
+    empty = [""] * 9
+    opening_list = list(empty)
+    opening_list[4] = "X"
+
+    def minimax_cold(board: List[str]):
+        core.TRANSPOSITIONS.clear()
+        return core.minimax_ab(board, 9, True, "O", "X", -9999, 9999)
+
+    cases = {
+        "check_winner": lambda: core.check_winner(mixed()),
+        "check_winner_list": lambda: core.check_winner(as_lists()),
+        "is_draw": lambda: core.is_draw(finished()),
+        "minimax_ab_empty_cold": lambda: minimax_cold(empty),
+        "minimax_ab_opening_cold": lambda: minimax_cold(opening_list),
+        "minimax_ab_opening_warm": lambda: core.minimax_ab(opening_list, 8, True, "O", "X", -9999, 9999),
+    }
+    for difficulty in ("easy", "medium", "hard"):
+        cases[f"ai_choose_move_{difficulty}"] = lambda d=difficulty: core.ai_choose_move(midgame(), d, offload=False)
+    for difficulty in ("medium", "hard"):
+        cases[f"search_ai_move_{difficulty}"] = lambda d=difficulty: core.search_ai_move(midgame(), d, offload=False)
+    return cases
+
+
+def render_cases(seed: int) -> Dict[str, Callable[[], object]]:
+    core.PROFILES.remember(types.User(PLAYER_X, False, "Sara", username="sara"))
+    core.PROFILES.remember(types.User(PLAYER_O, False, "Omid", username="omid"))
+    core._BOT_USERNAME = "bench_bot"
+    states = cycling([played_state(seed + i, i % 8, game_id=f"render{i:06d}") for i in range(64)])
+    win_state = played_state(seed, 5)
+    win_state.finished = True
+
+    def render_cold():
+        core.RENDERS = core.RenderCache(core.RENDER_CACHE_MAX)
+        return core.render_board(states())
+
+    return {
+        "render_board_warm": lambda: core.render_board(states()),
+        "render_board_cold": render_cold,
+        "render_board_win_frame": lambda: core.render_board(win_state, highlight=[0, 4, 8], anim_emoji=core.WIN_ANIM[0]),
+    }
+
+
+def state_cases(seed: int) -> Dict[str, Callable[[], object]]:
+    states = [played_state(seed + i, 3 + i % 6) for i in range(32)]
+    packed = cycling([(s.game_id, s.pack()) for s in states])
+    dicts = [legacy_dict(s) for s in states]
+    encoded = cycling([(s.game_id, json.dumps(d, ensure_ascii=False)) for s, d in zip(states, dicts)])
+    raw_dicts = cycling(dicts)
+    by_state = cycling(states)
+
+    def json_roundtrip():
+        gid, text = encoded()
+        return json.dumps(legacy_dict(core.GameState.from_dict(gid, json.loads(text))), ensure_ascii=False)
+
+    return {
+        "state_pack": lambda: by_state().pack(),
+        "state_unpack": lambda: core.GameState.unpack(*packed()),
+        "state_to_row": lambda: by_state().to_row(PLAYER_X, 1001, 1_700_000_000),
+        "state_json_dumps": lambda: json.dumps(raw_dicts(), ensure_ascii=False),
+        "state_json_roundtrip": json_roundtrip,
+    }
+
+
+def storage_cases(seed: int) -> Dict[str, Callable[[], object]]:
+    # نوشتن‌ها بدون start_runtime همان‌جا commit می‌شوند، پس هر فراخوانی هزینه واقعی دیسک را دارد
+    states = [played_state(seed + i, 4, game_id=f"store{i:07d}") for i in range(256)]
+    for s in states:
+        core.save_game(s.game_id, PLAYER_X, 1001, s)
+    core.GAME_CACHE.flush()
+    saves = cycling(states)
+    loads = cycling([s.game_id for s in states])
+    movers = cycling([played_state(seed + i, 0, game_id=f"moves{i:07d}") for i in range(256)])
+
+    def save_and_flush():
+        state = saves()
+        core.save_game(state.game_id, PLAYER_X, 1001, state)
+        return core.GAME_CACHE.flush()
+
+    def load_cold():
+        game_id = loads()
+        core.GAME_CACHE.discard(game_id)
+        return core.load_game(game_id)
+
+    def append_move():
+        state = movers()
+        if state.board.is_full() or core.check_winner(state.board):
+            state.reset()
+        state.play(state.board.legal_moves()[0], state.current_player, 1_700_000_000 + state.ply)
+        state.current_player = "O" if state.current_player == "X" else "X"
+        return core.GAME_CACHE.append_move(state.game_id, PLAYER_X, 1001, state)
+
+    return {
+        "save_game_flush": save_and_flush,
+        "load_game_cold": load_cold,
+        "load_game_cached": lambda: core.load_game(loads()),
+        "append_move": append_move,
+    }
+
+
+def measure(fn: Callable[[], object], min_time: float, repeat: int) -> Dict[str, float]:
+    fn()
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time / 5 or number >= 1 << 20:
+            break
+        number *= 2
+    runs = [t / number for t in timer.repeat(repeat, number)]
+
+    tracemalloc.start()
+    try:
+        peaks, blocks = [], []
+        for _ in range(ALLOC_CALLS):
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            peaks.append(peak - base)
+            blocks.append(sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0))
+    finally:
+        tracemalloc.stop()
+    return {
+        "number": number,
+        "best_us": round(min(runs) * 1e6, 3),
+        "median_us": round(statistics.median(runs) * 1e6, 3),
+        "alloc_peak_bytes": int(statistics.median(peaks)),
+        "alloc_blocks": int(statistics.median(blocks)),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def check(results: Dict[str, Dict], thresholds: Dict[str, Dict]) -> List[str]:
+    # سقف مطلق هر مورد؛ موردی که در فایل نیست بررسی نمی‌شود
+    failures = []
+    for name, limits in sorted(thresholds.items()):
+        result = results.get(name)
+        if result is None:
+            continue
+        if "max_us" in limits and result["median_us"] > limits["max_us"]:
+            failures.append(f"{name}: median {result['median_us']}us > {limits['max_us']}us")
+        if "max_alloc_bytes" in limits and result["alloc_peak_bytes"] > limits["max_alloc_bytes"]:
+            failures.append(f"{name}: alloc peak {result['alloc_peak_bytes']}B > {limits['max_alloc_bytes']}B")
+    return failures
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    # مقایسه نسبی با خروجی یک کامیت دیگر روی همان ماشین
+    failures = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["median_us"] > base["median_us"] * (1 + tolerance):
+            failures.append(f"{name}: median {base['median_us']}us -> {result['median_us']}us")
+        if result["alloc_peak_bytes"] > base["alloc_peak_bytes"] * (1 + tolerance) + 64:
+            failures.append(f"{name}: alloc peak {base['alloc_peak_bytes']}B -> {result['alloc_peak_bytes']}B")
+    return failures
+
+
+def thresholds_from(results: Dict[str, Dict], factor: float) -> Dict[str, Dict]:
+    return {
+        name: {"max_us": round(r["median_us"] * factor, 1), "max_alloc_bytes": int(r["alloc_peak_bytes"] * factor) + 1024}
+        for name, r in sorted(results.items())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and allocation benchmarks for the engine, rendering and storage hot paths")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="run only cases whose name contains this text")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--check", nargs="?", const=DEFAULT_THRESHOLDS, help="fail if a case exceeds its limits in this thresholds file")
+    parser.add_argument("--compare", help="fail if a case is slower or allocates more than in this earlier results file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown for --compare")
+    parser.add_argument("--write-thresholds", metavar="FACTOR", type=float, help="rewrite the thresholds file as FACTOR x these results")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nvs-bench-")
+    core.DB_POOL.path = os.path.join(workdir, "bench.db")
+    core.init_db()
+    try:
+        cases: Dict[str, Callable[[], object]] = {}
+        for group in (engine_cases, render_cases, state_cases, storage_cases):
+            cases.update(group(args.seed))
+        results: Dict[str, Dict] = {}
+        for name, fn in cases.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(fn, args.min_time, args.repeat)
+            print(f"{name:28s} {results[name]['median_us']:>12.3f} us  {results[name]['alloc_peak_bytes']:>8d} B", file=sys.stderr)
+    finally:
+        core.flush_games()
+        core.DB_POOL.close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+        "seed": args.seed,
+        "ai_engine": core.AI_ENGINE,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.write_thresholds:
+        path = args.check or DEFAULT_THRESHOLDS
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(thresholds_from(results, args.write_thresholds), f, indent=2)
+            f.write("\n")
+        print(f"thresholds written to {path}", file=sys.stderr)
+        return
+
+    failures: List[str] = []
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            failures += check(results, json.load(f))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            failures += compare(results, json.load(f).get("results", {}), args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
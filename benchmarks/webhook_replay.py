@@ -0,0 +1,135 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import List
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nvs_TicTacToeBOT_webhook as webhook
+
+
+# پخش دوباره آپدیت‌های ضبط‌شده روی سرور وبهوک، بدون تماس با تلگرام
+def synthetic_updates(count: int, seed: int, games: int = 200) -> List[dict]:
+    # کلیک‌ها همان قالب move_<gid>|<pos> بات را دارند و چند کاربر روی هر بازی می‌زنند تا بازی‌ها واقعاً رقابتی باشند
+    rng = random.Random(seed)
+    gids = [f"{rng.randrange(1 << 48):012x}" for _ in range(games)]
+    updates = []
+    for i in range(count):
+        user = {"id": 1000 + rng.randrange(500), "is_bot": False, "first_name": "u", "username": f"user{i % 500}"}
+        chat = {"id": user["id"], "type": "private"}
+        if rng.random() < 0.1:
+            updates.append({"update_id": i, "message": {"message_id": i, "date": 0, "chat": chat, "from": user,
+                                                        "text": "/play", "entities": [{"type": "bot_command", "offset": 0, "length": 5}]}})
+        else:
+            message = {"message_id": i, "date": 0, "chat": chat, "from": {"id": 1, "is_bot": True, "first_name": "bot"}, "text": "board"}
+            updates.append({"update_id": i, "callback_query": {"id": str(i), "from": user, "chat_instance": "c", "message": message,
+                                                               "data": f"move_{rng.choice(gids)}|{rng.randrange(9)}"}})
+    return updates
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def replay(url: str, secret: str, updates: List[dict], concurrency: int):
+    target = urlsplit(url)
+    bodies = [json.dumps(u).encode() for u in updates]
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers[webhook.SECRET_HEADER] = secret
+    latencies: List[float] = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(chunk):
+        conn = http.client.HTTPConnection(target.hostname, target.port, timeout=30)
+        local, codes = [], {}
+        for body in chunk:
+            start = time.perf_counter()
+            conn.request("POST", target.path or "/", body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            local.append(time.perf_counter() - start)
+            codes[response.status] = codes.get(response.status, 0) + 1
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            for code, n in codes.items():
+                statuses[code] = statuses.get(code, 0) + n
+
+    threads = [threading.Thread(target=worker, args=(bodies[i::concurrency],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the webhook server")
+    parser.add_argument("--updates", help="JSONL file with one recorded update per line")
+    parser.add_argument("--synthetic", type=int, default=5000, help="number of generated updates when --updates is not given")
+    parser.add_argument("--games", type=int, default=200, help="distinct game ids the generated move clicks are spread over")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--target", help="URL of a running webhook server; default starts one in-process")
+    parser.add_argument("--secret", default="replay-secret")
+    parser.add_argument("--work-ms", type=float, default=0.0, help="simulated handler time for the in-process server")
+    parser.add_argument("--queue-size", type=int, default=webhook.WEBHOOK_QUEUE_SIZE)
+    parser.add_argument("--workers", type=int, default=webhook.WEBHOOK_WORKERS)
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.synthetic, args.seed, args.games)
+    updates = updates * args.repeat
+
+    server = None
+    url = args.target
+    if not url:
+        def process(update):
+            if args.work_ms:
+                time.sleep(args.work_ms / 1000)
+
+        server = webhook.WebhookServer(host="127.0.0.1", port=0, secret=args.secret, queue_size=args.queue_size,
+                                       workers=args.workers, process=process)
+        server.start()
+        host, port = server.address
+        url = f"http://{host}:{port}{webhook.WEBHOOK_PATH}"
+
+    elapsed, latencies, statuses = replay(url, args.secret, updates, args.concurrency)
+    report = {
+        "updates": len(updates),
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+    }
+    if server is not None:
+        deadline = time.monotonic() + 30
+        while server.processed + server.failed < server.received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        server.stop()
+        report.update(received=server.received, processed=server.processed, dropped=server.dropped, rejected=server.rejected)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
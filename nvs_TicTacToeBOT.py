@@ -5,19 +5,55 @@ import threading
 import time
 import random
 import uuid
-from typing import Dict, List, Optional, Tuple
+import queue
+import heapq
+import struct
+import multiprocessing
+import atexit
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from functools import partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import telebot
-from telebot import types
+from telebot import apihelper, types
 
 
 BOT_TOKEN = "Token_Bot_Telegram"
+apihelper.ENABLE_MIDDLEWARE = True  # باید قبل از ساخت bot باشد
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
+CALLBACK_ROUTES: List[Tuple[str, Callable]] = []
+COMMAND_ROUTES: List[Tuple[str, Callable]] = []
+
+
+def callback_route(prefix: str):
+    def decorator(handler):
+        timed = instrument_route(prefix, handler)
+        CALLBACK_ROUTES.append((prefix, timed))
+        bot.register_callback_query_handler(timed, func=lambda call: call.data.startswith(prefix))
+        return timed
+    return decorator
+
+
+def command_route(command: str):
+    def decorator(handler):
+        timed = instrument_route(f"/{command}", handler)
+        COMMAND_ROUTES.append((command, timed))
+        bot.register_message_handler(timed, commands=[command])
+        return timed
+    return decorator
+
+
 DB_PATH = "data.db" # مسیر دیتابیس
 INACTIVITY_SECONDS = 5 * 60
 STALE_CLEANUP_SECONDS = 24 * 3600
-LOCK = threading.Lock()
-GAME_LOCKS: Dict[str, threading.Lock] = {}
 
 EMOJI_X = "❌"
 EMOJI_O = "⭕"
@@ -25,11 +61,461 @@ EMOJI_EMPTY = "⬜️"
 WIN_ANIM = ["✨", "💫", "🌟"]
 
 
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT = 10.0
+DB_STATEMENT_CACHE = 64
+DB_COMMIT_WINDOW = 0.005  # نوشتن‌ها این مدت جمع می‌شوند و با یک commit می‌روند
+DB_COMMIT_MAX_OPS = 256
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+SQL_SAVE_GAME = (
+    "REPLACE INTO games (game_id, chat_id, message_id, state_json, state_blob, state_version, last_activity, finished, current_player, deadline, ply) "
+    "VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+)
+SQL_LOAD_GAME = "SELECT chat_id, message_id, state_json, state_blob, last_activity, ply FROM games WHERE game_id=?"
+SQL_DELETE_GAME = "DELETE FROM games WHERE game_id=?"
+SQL_OPEN_DEADLINES = "SELECT game_id, deadline FROM games WHERE finished=0 AND deadline IS NOT NULL"
+SQL_DELETE_STALE = "DELETE FROM games WHERE finished=1 AND last_activity < ?"
+SQL_UNINDEXED_GAMES = "SELECT game_id, state_json, last_activity FROM games WHERE current_player IS NULL"
+SQL_INDEX_GAME = "UPDATE games SET finished=?, current_player=?, deadline=? WHERE game_id=?"
+SQL_JSON_STATES = "SELECT game_id, state_json, ply FROM games WHERE state_blob IS NULL AND state_json IS NOT NULL"
+SQL_PACK_STATE = "UPDATE games SET state_json=?, state_blob=?, state_version=?, ply=? WHERE game_id=?"
+SQL_APPEND_MOVE = "INSERT OR REPLACE INTO moves (game_id, ply, player, pos, ts) VALUES (?,?,?,?,?)"
+SQL_LOAD_MOVES = "SELECT ply, player, pos, ts FROM moves WHERE game_id=? ORDER BY ply"
+SQL_RESET_MOVES = "DELETE FROM moves WHERE game_id=?"
+SQL_DELETE_OLD_MOVES = "DELETE FROM moves WHERE ts < ? AND game_id NOT IN (SELECT game_id FROM games)"
+SQL_GET_STATS = "SELECT wins, losses, draws, win_streak, best_streak FROM stats WHERE user_id=?"
+
+
+class ConnectionPool:
+    # اتصال‌های ماندگار SQLite؛ هر نخ یک اتصال امانت می‌گیرد و بعد برمی‌گرداند
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+            timing = current_timing()
+            if timing is not None:
+                timing.db += time.perf_counter() - start
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+DB_POOL = ConnectionPool(DB_PATH)
+atexit.register(DB_POOL.close_all)
+
+
+# ---------- metrics ----------
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))  # 0 یعنی بدون endpoint
+METRICS_PATH = "/metrics"
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class MetricsRegistry:
+    # شمارنده و هیستوگرام برچسب‌دار در حافظه؛ gaugeها فقط موقع scrape از خود اشیا خوانده می‌شوند
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self._meta: "OrderedDict[str, Tuple[str, str, Tuple[str, ...]]]" = OrderedDict()
+        self._series: Dict[str, Dict[Tuple, object]] = {}
+        self._readers: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ("counter", help, labels)
+        self._series[name] = {}
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ("histogram", help, labels)
+        self._series[name] = {}
+
+    def gauge(self, name: str, help: str, read: Callable[[], float], kind: str = "gauge"):
+        # kind="counter" برای شمارنده‌هایی که خود اشیا نگه می‌دارند (Outbox، WRITES و ...)
+        self._meta[name] = (kind, help, ())
+        self._readers[name] = read
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1):
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: Tuple, value: float):
+        with self._lock:
+            series = self._series[name]
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = _Histogram(len(self.buckets) + 1)
+            hist.counts[bisect_left(self.buckets, value)] += 1
+            hist.total += value
+            hist.count += 1
+
+    def render(self) -> str:
+        with self._lock:
+            snapshot = {
+                name: {labels: (value if not isinstance(value, _Histogram) else (list(value.counts), value.total, value.count))
+                       for labels, value in series.items()}
+                for name, series in self._series.items()
+            }
+        lines = []
+        for name, (kind, help, label_names) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            reader = self._readers.get(name)
+            if reader is not None:
+                try:
+                    lines.append(f"{name} {float(reader())}")
+                except Exception as e:
+                    print(f"Metrics read error: {e}")
+                continue
+            for labels, value in sorted(snapshot[name].items()):
+                pairs = list(zip(label_names, labels))
+                if kind != "histogram":
+                    lines.append(f"{name}{_label_text(pairs)} {float(value)}")
+                    continue
+                counts, total, count = value
+                running = 0
+                for bound, n in zip(self.buckets + (float("inf"),), counts):
+                    running += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_label_text(pairs + [('le', le)])} {running}")
+                lines.append(f"{name}_sum{_label_text(pairs)} {total}")
+                lines.append(f"{name}_count{_label_text(pairs)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_text(pairs: List[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+METRICS = MetricsRegistry(METRICS_BUCKETS)
+METRICS.counter("nvs_handler_total", "Handled updates by route", ("route",))
+METRICS.counter("nvs_handler_errors_total", "Handler runs that hit an error by route", ("route",))
+METRICS.histogram("nvs_handler_seconds", "Update latency from dispatch to handler completion, shard queueing included", ("route",))
+METRICS.histogram("nvs_handler_db_seconds", "Time a handler held database connections", ("route",))
+METRICS.counter("nvs_telegram_calls_total", "Telegram Bot API calls by method", ("method",))
+METRICS.counter("nvs_telegram_429_total", "Telegram 429 responses by method", ("method",))
+METRICS.counter("nvs_telegram_errors_total", "Other failed Telegram calls by method", ("method",))
+
+
+class _HandlerTiming:
+    __slots__ = ("route", "start", "db", "failed", "deferred")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.failed = False
+        self.deferred = False
+
+
+_SCOPE = threading.local()
+
+
+def current_timing() -> Optional[_HandlerTiming]:
+    return getattr(_SCOPE, "timing", None)
+
+
+def run_timed(timing: _HandlerTiming, handler: Callable, update):
+    # اگر هندلر خودش را به شارد بازی سپرد (deferred)، زمان‌گیری همان‌جا تمام می‌شود
+    previous = current_timing()
+    _SCOPE.timing = timing
+    try:
+        return handler(update)
+    except Exception:
+        timing.failed = True
+        raise
+    finally:
+        _SCOPE.timing = previous
+        if not timing.deferred:
+            finish_timing(timing)
+
+
+def resume_timed(timing: _HandlerTiming, handler: Callable, update):
+    timing.deferred = False
+    return run_timed(timing, handler, update)
+
+
+def finish_timing(timing: _HandlerTiming):
+    labels = (timing.route,)
+    METRICS.observe("nvs_handler_seconds", labels, time.perf_counter() - timing.start)
+    METRICS.observe("nvs_handler_db_seconds", labels, timing.db)
+    METRICS.inc("nvs_handler_total", labels)
+    if timing.failed:
+        METRICS.inc("nvs_handler_errors_total", labels)
+
+
+def instrument_route(route: str, handler: Callable) -> Callable:
+    @wraps(handler)
+    def timed(update):
+        return run_timed(_HandlerTiming(route), handler, update)
+    return timed
+
+
+def handler_error(label: str, e: Exception):
+    print(f"{label} error: {e}")
+    timing = current_timing()
+    if timing is not None:
+        timing.failed = True
+
+
+class CountingApi:
+    # هر تماس با تلگرام بر اساس متد شمرده می‌شود؛ تابع پیچیده‌شده روی خود شیء می‌ماند تا بار بعد getattr نخورد
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+        labels = (name,)
+
+        def call(*args, **kwargs):
+            METRICS.inc("nvs_telegram_calls_total", labels)
+            try:
+                return attr(*args, **kwargs)
+            except apihelper.ApiTelegramException as e:
+                METRICS.inc("nvs_telegram_429_total" if e.error_code == 429 else "nvs_telegram_errors_total", labels)
+                raise
+            except Exception:
+                METRICS.inc("nvs_telegram_errors_total", labels)
+                raise
+        setattr(self, name, call)
+        return call
+
+
+API = CountingApi(bot)  # همه تماس‌های هسته با تلگرام از این شیء می‌گذرند و بر اساس متد شمرده می‌شوند؛ حالت async با use_runtime عوضش می‌کند
+
+
+# ---------- group commit ----------
+class _WriteGroup:
+    __slots__ = ("ops", "future")
+
+    def __init__(self, ops: List[Tuple[str, object, bool]]):
+        self.ops = ops
+        self.future: Future = Future()
+
+
+class GroupCommitter:
+    # نوشتن‌های همه بازی‌ها چند میلی‌ثانیه یا تا N دستور جمع می‌شوند و در یک تراکنش (یک sync دیسک) commit می‌شوند؛
+    # هر گروه اتمی است و Future آن بعد از commit کامل می‌شود تا هر کس تأیید دوام لازم دارد صبر کند
+    def __init__(self, pool: ConnectionPool, window: float, max_ops: int):
+        self.pool = pool
+        self.window = window
+        self.max_ops = max_ops
+        self._queue: List[_WriteGroup] = []
+        self._ops = 0
+        self._busy = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._cond:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join(timeout)
+
+    def execute(self, sql: str, params: Tuple = ()) -> Future:
+        return self.submit([(sql, params, False)])
+
+    def executemany(self, sql: str, rows: List[Tuple]) -> Future:
+        return self.submit([(sql, rows, True)])
+
+    def submit(self, ops: List[Tuple[str, object, bool]]) -> Future:
+        # نتیجه Future به ازای هر دستور rowcount آن است، یا ردیف‌ها اگر دستور SELECT باشد
+        group = _WriteGroup(ops)
+        with self._cond:
+            if self._thread is not None:
+                self._queue.append(group)
+                self._ops += len(ops)
+                if len(self._queue) == 1 or self._ops >= self.max_ops:
+                    self._cond.notify_all()
+                return group.future
+        # قبل از start_runtime (اسکریپت‌ها و مهاجرت) همان‌جا نوشته می‌شود
+        self._commit([group])
+        return group.future
+
+    def sync(self, timeout: Optional[float] = None) -> bool:
+        # صبر تا همه نوشتن‌های ثبت‌شده تا این لحظه commit شوند
+        with self._cond:
+            if self._thread is None or not (self._queue or self._busy):
+                return True
+        try:
+            self.submit([]).result(timeout)
+        except FuturesTimeout:
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = time.monotonic() + self.window
+                while self._ops < self.max_ops and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._queue = self._queue, []
+                self._ops = 0
+                self._busy = True
+            self._commit(batch)
+            with self._cond:
+                self._busy = False
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, ops: List[Tuple[str, object, bool]]) -> List:
+        results = []
+        for sql, params, many in ops:
+            cur = (conn.executemany if many else conn.execute)(sql, params)
+            results.append(cur.fetchall() if cur.description else cur.rowcount)
+        return results
+
+    def _commit(self, batch: List[_WriteGroup]):
+        try:
+            with self.pool.connection() as conn, conn:
+                results = [self._apply(conn, group.ops) for group in batch]
+        except Exception as e:
+            if len(batch) > 1:
+                # یک گروه خراب نباید نوشتن بقیه را از بین ببرد
+                for group in batch:
+                    self._commit([group])
+                return
+            self.failed += 1
+            print(f"Group commit error: {e}")
+            batch[0].future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += sum(len(group.ops) for group in batch)
+        for group, result in zip(batch, results):
+            group.future.set_result(result)
+
+
+WRITES = GroupCommitter(DB_POOL, DB_COMMIT_WINDOW, DB_COMMIT_MAX_OPS)
+atexit.register(WRITES.stop)
+
+
+def game_deadline(state: "GameState", last_activity: int) -> Optional[int]:
+    return None if state.finished else last_activity + INACTIVITY_SECONDS
+
+
+def game_index_columns(state: "GameState", last_activity: int) -> Tuple[int, str, Optional[int]]:
+    return int(state.finished), state.current_player, game_deadline(state, last_activity)
+
+
+# ---------- compact state encoding ----------
+# نسخه ۰ همان JSON قدیمی در state_json است؛ نسخه ۱ بایت‌های ثابت‌طول در state_blob
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct("<BBHHqqB")  # version, flags, x, o, player X, player O, messages
+STATE_MESSAGE = struct.Struct("<Bqq")  # player, chat_id, message_id
+STATE_ENCODE_ERRORS = (KeyError, TypeError, ValueError, struct.error)
+STATE_GAME_TYPES = ("pvp", "ai")
+STATE_DIFFICULTIES = (None, "easy", "medium", "hard")
+STATE_WINNERS = (None, "X", "O", "draw")
+STATE_PLAYERS = ("X", "O")
+PLAYER_AI_ID = -1
+
+
+def _pack_player(player) -> int:
+    if player is None:
+        return 0
+    if player == "AI":
+        return PLAYER_AI_ID
+    if type(player) is not int or player <= 0:
+        raise ValueError(f"unpackable player {player!r}")
+    return player
+
+
+def _unpack_player(value: int):
+    if value == 0:
+        return None
+    return "AI" if value == PLAYER_AI_ID else value
+
+
 def init_db():
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
+    with DB_POOL.connection() as conn, conn:
+        conn.execute(
             """
         CREATE TABLE IF NOT EXISTS games (
             game_id TEXT PRIMARY KEY,
@@ -40,7 +526,51 @@ def init_db():
         )
         """
         )
-        cur.execute(
+        # ستون‌های ایندکس‌شده برای زمان‌بندی تایم‌اوت و پاکسازی، بدون باز کردن state_json
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(games)")}
+        for name, decl in (
+            ("finished", "INTEGER DEFAULT 0"),
+            ("current_player", "TEXT"),
+            ("deadline", "INTEGER"),
+            ("ply", "INTEGER"),
+            ("state_blob", "BLOB"),
+            ("state_version", "INTEGER DEFAULT 0"),
+        ):
+            if name not in columns:
+                conn.execute(f"ALTER TABLE games ADD COLUMN {name} {decl}")
+        for game_id, state_json, last_activity in conn.execute(SQL_UNINDEXED_GAMES).fetchall():
+            st = GameState.from_dict(game_id, json.loads(state_json))
+            conn.execute(SQL_INDEX_GAME, game_index_columns(st, last_activity) + (game_id,))
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_games_deadline ON games (finished, deadline)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_games_activity ON games (finished, last_activity)")
+        # لاگ فقط‌افزودنی حرکت‌ها؛ state_json فقط اسنپ‌شات دوره‌ای بدون history است
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS moves (
+            game_id TEXT,
+            ply INTEGER,
+            player TEXT,
+            pos INTEGER,
+            ts INTEGER,
+            PRIMARY KEY (game_id, ply)
+        ) WITHOUT ROWID
+        """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_moves_ts ON moves (ts)")
+        # ردیف‌های JSON قدیمی: history به لاگ حرکت‌ها می‌رود و state به قالب باینری
+        for game_id, state_json, ply in conn.execute(SQL_JSON_STATES).fetchall():
+            raw = json.loads(state_json)
+            st = GameState.from_dict(game_id, raw)
+            if ply is None:
+                conn.executemany(SQL_APPEND_MOVE, st.move_rows())
+                ply = st.ply
+            raw.pop("history", None)
+            try:
+                conn.execute(SQL_PACK_STATE, (None, st.pack(), STATE_VERSION, ply, game_id))
+            except STATE_ENCODE_ERRORS:
+                # همان JSON می‌ماند و خواننده قدیمی آن را می‌خواند
+                conn.execute(SQL_PACK_STATE, (json.dumps(raw, ensure_ascii=False), None, 0, ply, game_id))
+        conn.execute(
             """
         CREATE TABLE IF NOT EXISTS stats (
             user_id INTEGER PRIMARY KEY,
@@ -52,53 +582,338 @@ def init_db():
         )
         """
         )
-        conn.commit()
-        conn.close()
 
 
-def save_game(game_id: str, chat_id: int, message_id: Optional[int], state: Dict):
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        now = int(time.time())
-        j = json.dumps(state, ensure_ascii=False)
-        cur.execute(
-            "REPLACE INTO games (game_id, chat_id, message_id, state_json, last_activity) VALUES (?,?,?,?,?)",
-            (game_id, chat_id, message_id or 0, j, now),
-        )
-        conn.commit()
-        conn.close()
+def _db_save_games(rows: List[Tuple]) -> Future:
+    return WRITES.executemany(SQL_SAVE_GAME, rows)
 
 
-def load_game(game_id: str) -> Optional[Tuple[int, Optional[int], Dict, int]]:
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT chat_id, message_id, state_json, last_activity FROM games WHERE game_id=?", (game_id,))
-        row = cur.fetchone()
-        conn.close()
+def _db_load_game(game_id: str) -> Optional[Tuple[int, Optional[int], "GameState", int, int]]:
+    # بدون WRITES.sync: بازی‌ای که نوشتنش هنوز در صف است از کش بیرون نمی‌رود، پس این‌جا فقط داده commit‌شده خوانده می‌شود
+    with DB_POOL.connection() as conn:
+        row = conn.execute(SQL_LOAD_GAME, (game_id,)).fetchone()
         if not row:
             return None
-        chat_id, message_id, state_json, last_activity = row
-        return chat_id, message_id if message_id != 0 else None, json.loads(state_json), last_activity
+        moves = conn.execute(SQL_LOAD_MOVES, (game_id,)).fetchall()
+    chat_id, message_id, state_json, state_blob, last_activity, snap_ply = row
+    state = GameState.from_row(game_id, state_json, state_blob)
+    if moves:
+        state.replay(moves, snap_ply or 0)
+        last_activity = max(last_activity, moves[-1][3])
+    return chat_id, message_id if message_id != 0 else None, state, last_activity, snap_ply or 0
+
+
+class _CachedGame:
+    __slots__ = ("chat_id", "message_id", "state", "last_activity", "snap_ply", "dirty", "seen", "writes")
+
+    def __init__(self, chat_id: int, message_id: Optional[int], state: "GameState", last_activity: int, snap_ply: int = 0, dirty: bool = False):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.state = state
+        self.last_activity = last_activity
+        self.snap_ply = snap_ply
+        self.dirty = dirty
+        self.seen = time.monotonic()
+        self.writes: List[Future] = []
+
+    def busy(self) -> bool:
+        # نوشتنی از این بازی هنوز commit نشده؛ بیرون انداختنش یعنی بارگذاری بعدی داده کهنه می‌خواند
+        if self.writes:
+            self.writes = [f for f in self.writes if not f.done()]
+        return bool(self.writes)
+
+
+def _settle(done: Future, marker: Future):
+    # marker پیش از صف شدن نوشتن روی ورودی‌ها گذاشته می‌شود و با تمام شدن خود نوشتن (موفق یا نه) آزاد می‌شود
+    done.add_done_callback(lambda _: marker.set_result(None))
+
+
+class GameCache:
+    # کش write-back بازی‌های زنده؛ تغییرات در حافظه می‌مانند و دوره‌ای در دیتابیس نوشته می‌شوند
+    def __init__(self, max_size: int, ttl: float, finished_ttl: float, snapshot_every: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.finished_ttl = finished_ttl
+        self.snapshot_every = snapshot_every
+        self._games: "OrderedDict[str, _CachedGame]" = OrderedDict()
+        self._lock = threading.Lock()
+        # از گرفتن اسنپ‌شات تا صف شدن نوشتن نگه داشته می‌شود؛ حذفی که وسط این دو برسد
+        # یا اسنپ‌شات را نمی‌بیند یا DELETE آن بعد از upsert صف می‌شود، پس ردیف حذف‌شده زنده نمی‌شود
+        self._write_lock = threading.Lock()
+        # بازی‌های حذف‌شده‌ای که DELETE آن‌ها هنوز commit نشده؛ بارگذاری از دیتابیس در این فاصله ردیف کهنه را زنده می‌کرد
+        self._deleted: Dict[str, Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def get(self, game_id: str) -> Optional[Tuple[int, Optional[int], "GameState", int]]:
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is not None:
+                self._games.move_to_end(game_id)
+                entry.seen = time.monotonic()
+                return entry.chat_id, entry.message_id, entry.state, entry.last_activity
+            gone = self._deleted.get(game_id)
+            if gone is not None and not gone.done():
+                return None
+        loaded = _db_load_game(game_id)
+        if not loaded:
+            return None
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is None:
+                entry = _CachedGame(*loaded)
+                self._games[game_id] = entry
+                self._evict_overflow()
+            return entry.chat_id, entry.message_id, entry.state, entry.last_activity
+
+    def put(self, game_id: str, chat_id: int, message_id: Optional[int], state: "GameState"):
+        now = int(time.time())
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is None:
+                self._games[game_id] = _CachedGame(chat_id, message_id, state, now, dirty=True)
+            else:
+                entry.chat_id = chat_id
+                entry.message_id = message_id
+                entry.state = state
+                entry.last_activity = now
+                entry.dirty = True
+                entry.seen = time.monotonic()
+                self._games.move_to_end(game_id)
+            self._evict_overflow()
+
+    def append_move(self, game_id: str, chat_id: int, message_id: Optional[int], state: "GameState"):
+        # هر حرکت یک INSERT کوچک است؛ اسنپ‌شات کامل فقط هر چند حرکت یک بار
+        ply = state.ply
+        player, pos, ts = state.last_move()
+        done = WRITES.execute(SQL_APPEND_MOVE, (game_id, ply, player, pos, ts))
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is None:
+                entry = self._games[game_id] = _CachedGame(chat_id, message_id, state, ts, dirty=True)
+                entry.writes.append(done)
+                self._evict_overflow()
+                return
+            entry.writes.append(done)
+            entry.state = state
+            entry.last_activity = ts
+            entry.seen = time.monotonic()
+            if ply - entry.snap_ply >= self.snapshot_every:
+                entry.dirty = True
+            self._games.move_to_end(game_id)
+
+    def reset_moves(self, game_id: str):
+        # ریست بازی: لاگ حرکت‌ها و اسنپ‌شات تازه با هم نوشته می‌شوند تا دنباله قدیمی روی صفحه نو اعمال نشود
+        with self._write_lock:
+            marker = Future()
+            with self._lock:
+                entry = self._games.get(game_id)
+                row = self._snapshot(entry, marker) if entry is not None else None
+            ops = [(SQL_RESET_MOVES, (game_id,), False)]
+            if row is not None:
+                ops.append((SQL_SAVE_GAME, row, False))
+            _settle(WRITES.submit(ops), marker)
+
+    def mark_dirty(self, game_id: str):
+        # تغییر جانبی (مثل پیام تازه بورد) بدون جابه‌جا کردن زمان فعالیت بازی
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is not None:
+                entry.dirty = True
+
+    def relink(self, game_id: str, chat_id: int, message_id: Optional[int]):
+        # پیام اصلی بازی عوض می‌شود؛ مثل mark_dirty زمان فعالیت دست نمی‌خورد
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is not None:
+                entry.chat_id = chat_id
+                entry.message_id = message_id
+                entry.dirty = True
+
+    def discard(self, game_id: str):
+        with self._lock:
+            self._games.pop(game_id, None)
+
+    def flush(self, evict: bool = False) -> Optional[Future]:
+        with self._write_lock:
+            return self._flush(evict)
+
+    def _flush(self, evict: bool) -> Optional[Future]:
+        mono = time.monotonic()
+        rows = []
+        marker = Future()
+        with self._lock:
+            for gid, entry in list(self._games.items()):
+                if entry.dirty:
+                    rows.append(self._snapshot(entry, marker))
+                    # فقط ورودی‌هایی که قبلاً در دیتابیس نشسته‌اند بیرون می‌روند
+                    continue
+                if not evict:
+                    continue
+                ttl = self.finished_ttl if entry.state.finished else self.ttl
+                if mono - entry.seen > ttl and not entry.busy():
+                    del self._games[gid]
+            if evict:
+                for gid in [gid for gid, gone in self._deleted.items() if gone.done()]:
+                    del self._deleted[gid]
+        if not rows:
+            return None
+        try:
+            done = _db_save_games(rows)
+        except Exception:
+            marker.set_result(None)
+            raise
+        _settle(done, marker)
+        return done
+
+    def _evict_overflow(self):
+        excess = len(self._games) - self.max_size
+        if excess <= 0:
+            return
+        victims = list(islice((gid for gid, entry in self._games.items() if not entry.dirty and not entry.busy()), excess))
+        for gid in victims:
+            del self._games[gid]
+
+    @staticmethod
+    def _snapshot(entry: _CachedGame, marker: Future) -> Tuple:
+        entry.dirty = False
+        entry.writes.append(marker)
+        row = entry.state.to_row(entry.chat_id, entry.message_id, entry.last_activity)
+        entry.snap_ply = row[-1]
+        return row
+
+    def _bury(self, game_ids: List[str]) -> Future:
+        # صدا زده با _lock گرفته‌شده؛ ورودی‌ها تا commit شدن DELETE به عنوان حذف‌شده می‌مانند
+        marker = Future()
+        for gid in game_ids:
+            self._games.pop(gid, None)
+            self._deleted[gid] = marker
+        return marker
+
+    def delete(self, game_id: str):
+        with self._write_lock:
+            with self._lock:
+                marker = self._bury([game_id])
+            _settle(WRITES.execute(SQL_DELETE_GAME, (game_id,)), marker)
+
+    def delete_stale(self, cutoff: int) -> int:
+        with self._write_lock:
+            self._flush(False)
+            with self._lock:
+                marker = self._bury([gid for gid, entry in self._games.items()
+                                     if entry.state.finished and entry.last_activity < cutoff])
+            done = WRITES.submit([(SQL_DELETE_STALE, (cutoff,), False), (SQL_DELETE_OLD_MOVES, (cutoff,), False)])
+            _settle(done, marker)
+        return done.result()[0]
+
+
+class DeadlineScheduler:
+    # min-heap از ددلاین بازی‌ها؛ ورودی‌های قدیمی heap به صورت تنبل دور ریخته می‌شوند
+    def __init__(self):
+        self._heap: List[Tuple[int, str]] = []
+        self._deadlines: Dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, game_id: str, deadline: int):
+        with self._cond:
+            if self._deadlines.get(game_id) == deadline:
+                return
+            self._deadlines[game_id] = deadline
+            heapq.heappush(self._heap, (deadline, game_id))
+            if self._heap[0] == (deadline, game_id):
+                self._cond.notify()
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._heap = [(d, g) for g, d in self._deadlines.items()]
+                heapq.heapify(self._heap)
+
+    def cancel(self, game_id: str):
+        with self._cond:
+            self._deadlines.pop(game_id, None)
+
+    def next_expired(self, timeout: float) -> Optional[str]:
+        end = time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap:
+                    deadline, game_id = self._heap[0]
+                    if self._deadlines.get(game_id) != deadline:
+                        heapq.heappop(self._heap)
+                        continue
+                    if deadline <= now:
+                        heapq.heappop(self._heap)
+                        del self._deadlines[game_id]
+                        return game_id
+                    wait = min(deadline, end) - now
+                else:
+                    wait = end - now
+                if wait <= 0:
+                    return None
+                self._cond.wait(wait)
+
+
+STALE_SWEEP_SECONDS = 10 * 60
+DEADLINES = DeadlineScheduler()
+GAME_CACHE_MAX = 20000
+GAME_CACHE_TTL = 15 * 60
+GAME_CACHE_FINISHED_TTL = 60
+GAME_FLUSH_INTERVAL = 2.0
+GAME_SNAPSHOT_EVERY = 4  # هر چند حرکت یک اسنپ‌شات کامل
+GAME_CACHE = GameCache(GAME_CACHE_MAX, GAME_CACHE_TTL, GAME_CACHE_FINISHED_TTL, GAME_SNAPSHOT_EVERY)
+
+
+def save_game(game_id: str, chat_id: int, message_id: Optional[int], state: "GameState"):
+    GAME_CACHE.put(game_id, chat_id, message_id, state)
+    if state.finished:
+        DEADLINES.cancel(game_id)
+    else:
+        DEADLINES.schedule(game_id, int(time.time()) + INACTIVITY_SECONDS)
+
+
+def load_game(game_id: str) -> Optional[Tuple[int, Optional[int], "GameState", int]]:
+    return GAME_CACHE.get(game_id)
 
 
 def delete_game(game_id: str):
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM games WHERE game_id=?", (game_id,))
-        conn.commit()
-        conn.close()
+    DEADLINES.cancel(game_id)
+    GAME_CACHE.delete(game_id)
+
+
+def record_move(game_id: str, chat_id: int, message_id: Optional[int], state: "GameState"):
+    GAME_CACHE.append_move(game_id, chat_id, message_id, state)
+    if not state.finished:
+        DEADLINES.schedule(game_id, state.last_move()[2] + INACTIVITY_SECONDS)
+
+
+def restart_game(game_id: str, chat_id: int, message_id: Optional[int], state: "GameState"):
+    save_game(game_id, chat_id, message_id, state)
+    GAME_CACHE.reset_moves(game_id)
+
+
+def flush_games():
+    try:
+        done = GAME_CACHE.flush()
+        if done is not None:
+            done.result()
+        WRITES.sync()
+    except Exception as e:
+        print(f"Game flush error: {e}")
+
+
+def game_flusher():
+    while True:
+        time.sleep(GAME_FLUSH_INTERVAL)
+        try:
+            GAME_CACHE.flush(evict=True)
+        except Exception as e:
+            print(f"Game flush error: {e}")
 
 
-def update_last_activity(game_id: str):
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("UPDATE games SET last_activity=? WHERE game_id=?", (int(time.time()), game_id))
-        conn.commit()
-        conn.close()
+atexit.register(flush_games)
 
 
 WIN_LINES = [
@@ -111,248 +926,1729 @@ WIN_LINES = [
     (0, 4, 8),
     (2, 4, 6),
 ]
+FULL_MASK = 0x1FF
+WIN_MASKS = tuple((1 << a) | (1 << b) | (1 << c) for a, b, c in WIN_LINES)
+LINES_THROUGH = tuple(tuple(m for m in WIN_MASKS if m >> i & 1) for i in range(9))
+
+
+class Bitboard:
+    # دو عدد ۹ بیتی: بیت i در x یعنی خانه i مال X است
+    __slots__ = ("x", "o")
+
+    def __init__(self, x: int = 0, o: int = 0):
+        self.x = x
+        self.o = o
+
+    @classmethod
+    def from_list(cls, board: List[str]) -> "Bitboard":
+        x = o = 0
+        for i, cell in enumerate(board):
+            if cell == "X":
+                x |= 1 << i
+            elif cell == "O":
+                o |= 1 << i
+        return cls(x, o)
+
+    def to_list(self) -> List[str]:
+        return ["X" if self.x >> i & 1 else "O" if self.o >> i & 1 else "" for i in range(9)]
+
+    def __getitem__(self, i: int) -> str:
+        if self.x >> i & 1:
+            return "X"
+        if self.o >> i & 1:
+            return "O"
+        return ""
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitboard) and self.x == other.x and self.o == other.o
+
+    def __hash__(self) -> int:
+        return self.x | self.o << 9
+
+    def __repr__(self) -> str:
+        return f"Bitboard(x={self.x:#05x}, o={self.o:#05x})"
+
+    @property
+    def occupied(self) -> int:
+        return self.x | self.o
+
+    def play(self, pos: int, player: str):
+        if player == "X":
+            self.x |= 1 << pos
+        else:
+            self.o |= 1 << pos
+
+    def to_move(self) -> str:
+        return "X" if bin(self.x).count("1") == bin(self.o).count("1") else "O"
+
+    def legal_moves(self) -> List[int]:
+        return legal_moves(self.x | self.o)
+
+    def winner(self) -> Optional[Tuple[str, List[int]]]:
+        return winner_bits(self.x, self.o)
+
+    def is_full(self) -> bool:
+        return (self.x | self.o) == FULL_MASK
+
+
+def legal_moves(occupied: int) -> List[int]:
+    moves = []
+    free = FULL_MASK & ~occupied
+    while free:
+        low = free & -free
+        moves.append(low.bit_length() - 1)
+        free ^= low
+    return moves
+
+
+def mask_cells(mask: int) -> List[int]:
+    return [i for i in range(9) if mask >> i & 1]
+
+
+def line_mask(bits: int) -> int:
+    for m in WIN_MASKS:
+        if bits & m == m:
+            return m
+    return 0
+
+
+def winner_bits(x: int, o: int) -> Optional[Tuple[str, List[int]]]:
+    m = line_mask(x)
+    if m:
+        return "X", mask_cells(m)
+    m = line_mask(o)
+    if m:
+        return "O", mask_cells(m)
+    return None
+
 
+def wins_through(bits: int, pos: int) -> bool:
+    for m in LINES_THROUGH[pos]:
+        if bits & m == m:
+            return True
+    return False
 
-def new_game(game_type: str, creator_id: int, opponent_id: Optional[int] = None, ai_difficulty: Optional[str] = None) -> Dict:
-    state = {
-        "board": [""] * 9,
-        "current_player": "X",
-        "game_type": game_type,
-        "players": {"X": creator_id, "O": opponent_id if opponent_id else None},
-        "ai_difficulty": ai_difficulty,
-        "history": [],
-        "finished": False,
-        "winner": None,
-        "_id": None,
-        "messages": {},
-    }
-    return state
+
+MOVE_O_BIT = 0x10  # در آرایه history: چهار بیت پایین خانه، این بیت یعنی حرکت O
+
+
+def _known(value, allowed: Tuple, default):
+    return value if value in allowed else default
+
+
+def _known_player(value):
+    return value if value == "AI" or (type(value) is int and value > 0) else None
+
+
+class GameState:
+    # وضعیت یک بازی با فیلدهای ثابت؛ صفحه بیت‌بورد و تاریخچه دو آرایه فشرده (خانه، زمان)
+    __slots__ = (
+        "game_id", "board", "current_player", "game_type", "player_x", "player_o", "ai_difficulty",
+        "moves", "move_times", "finished", "winner", "message_x", "message_o",
+    )
+
+    def __init__(self, game_id: Optional[str] = None, game_type: str = "pvp", player_x: Optional[int] = None,
+                 player_o=None, ai_difficulty: Optional[str] = None):
+        self.game_id = game_id
+        self.board = Bitboard()
+        self.current_player = "X"
+        self.game_type = game_type
+        self.player_x = player_x
+        self.player_o = player_o  # شناسه کاربر، "AI" یا None
+        self.ai_difficulty = ai_difficulty
+        self.moves = array("B")
+        self.move_times = array("q")
+        self.finished = False
+        self.winner: Optional[str] = None
+        self.message_x: Optional[Tuple[int, int]] = None  # (chat_id, message_id) بورد هر بازیکن
+        self.message_o: Optional[Tuple[int, int]] = None
+
+    @property
+    def ply(self) -> int:
+        return len(self.moves)
+
+    def player(self, side: str):
+        return self.player_x if side == "X" else self.player_o
+
+    def set_player(self, side: str, player):
+        if side == "X":
+            self.player_x = player
+        else:
+            self.player_o = player
+
+    def role_of(self, user_id: int) -> Optional[str]:
+        if self.player_x == user_id:
+            return "X"
+        if self.player_o == user_id:
+            return "O"
+        return None
+
+    def message(self, side: str) -> Optional[Tuple[int, int]]:
+        return self.message_x if side == "X" else self.message_o
+
+    def set_message(self, side: str, chat_id: int, message_id: Optional[int]):
+        if side == "X":
+            self.message_x = (chat_id, message_id)
+        else:
+            self.message_o = (chat_id, message_id)
+
+    def _append_move(self, player: str, pos: int, ts: int):
+        self.moves.append(pos | MOVE_O_BIT if player == "O" else pos)
+        self.move_times.append(ts)
+
+    def play(self, pos: int, player: str, ts: int):
+        self.board.play(pos, player)
+        self._append_move(player, pos, ts)
+
+    def last_move(self) -> Tuple[str, int, int]:
+        move = self.moves[-1]
+        return ("O" if move & MOVE_O_BIT else "X"), move & 0xF, self.move_times[-1]
+
+    def move_rows(self) -> List[Tuple[str, int, str, int, int]]:
+        return [
+            (self.game_id, ply, "O" if move & MOVE_O_BIT else "X", move & 0xF, ts)
+            for ply, (move, ts) in enumerate(zip(self.moves, self.move_times), 1)
+        ]
+
+    def reset(self):
+        self.board = Bitboard()
+        self.current_player = "X"
+        self.moves = array("B")
+        self.move_times = array("q")
+        self.finished = False
+        self.winner = None
+
+    def replay(self, rows: List[Tuple[int, str, int, int]], snap_ply: int):
+        # اسنپ‌شات + دنباله: history کامل از لاگ، حرکت‌های بعد از اسنپ‌شات روی صفحه
+        self.moves = array("B")
+        self.move_times = array("q")
+        for ply, player, pos, ts in rows:
+            self._append_move(player, pos, ts)
+            if ply > snap_ply:
+                self.board.play(pos, player)
+        if rows and not self.finished:
+            # بازی ممکن است بعد از آخرین اسنپ‌شات تمام شده باشد؛ نتیجه از خود صفحه درمی‌آید
+            won = winner_bits(self.board.x, self.board.o)
+            if won:
+                self.finished, self.winner = True, won[0]
+            elif self.board.is_full():
+                self.finished, self.winner = True, "draw"
+            else:
+                self.current_player = "O" if rows[-1][1] == "X" else "X"
+
+    def pack(self) -> bytes:
+        board = self.board
+        flags = (
+            int(self.finished)
+            | STATE_GAME_TYPES.index(self.game_type) << 1
+            | STATE_PLAYERS.index(self.current_player) << 2
+            | STATE_WINNERS.index(self.winner) << 3
+            | STATE_DIFFICULTIES.index(self.ai_difficulty) << 5
+        )
+        messages = [(side, msg) for side, msg in enumerate((self.message_x, self.message_o)) if msg]
+        parts = [STATE_HEADER.pack(STATE_VERSION, flags, board.x, board.o, _pack_player(self.player_x), _pack_player(self.player_o), len(messages))]
+        for side, (chat_id, message_id) in messages:
+            parts.append(STATE_MESSAGE.pack(side, chat_id or 0, message_id or 0))
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, game_id: str, blob: bytes) -> "GameState":
+        if blob[0] != STATE_VERSION:
+            raise ValueError(f"unknown state version {blob[0]}")
+        _, flags, x, o, player_x, player_o, count = STATE_HEADER.unpack_from(blob)
+        state = cls(game_id, STATE_GAME_TYPES[flags >> 1 & 1], _unpack_player(player_x), _unpack_player(player_o), STATE_DIFFICULTIES[flags >> 5 & 3])
+        state.board = Bitboard(x, o)
+        state.current_player = STATE_PLAYERS[flags >> 2 & 1]
+        state.finished = bool(flags & 1)
+        state.winner = STATE_WINNERS[flags >> 3 & 3]
+        for i in range(count):
+            side, chat_id, message_id = STATE_MESSAGE.unpack_from(blob, STATE_HEADER.size + i * STATE_MESSAGE.size)
+            state.set_message(STATE_PLAYERS[side], chat_id or None, message_id or None)
+        return state
+
+    @classmethod
+    def from_dict(cls, game_id: str, data: Dict) -> "GameState":
+        # state_json قدیمی (نسخه ۰)؛ مقدار ناشناخته به پیش‌فرض برمی‌گردد تا pack شکست نخورد
+        players = data.get("players") or {}
+        state = cls(
+            game_id,
+            _known(data.get("game_type"), STATE_GAME_TYPES, "pvp"),
+            _known_player(players.get("X")),
+            _known_player(players.get("O")),
+            _known(data.get("ai_difficulty"), STATE_DIFFICULTIES, None),
+        )
+        state.board = Bitboard.from_list(data.get("board") or [""] * 9)
+        state.current_player = _known(data.get("current_player"), STATE_PLAYERS, "X")
+        for h in data.get("history") or ():
+            state._append_move(h["player"], h["pos"], h.get("time", 0))
+        state.finished = bool(data.get("finished"))
+        state.winner = _known(data.get("winner"), STATE_WINNERS, None)
+        for side, info in (data.get("messages") or {}).items():
+            if side in STATE_PLAYERS and info:
+                state.set_message(side, info.get("chat_id"), info.get("message_id"))
+        return state
+
+    @classmethod
+    def from_row(cls, game_id: str, state_json: Optional[str], state_blob: Optional[bytes]) -> "GameState":
+        if state_blob is not None:
+            return cls.unpack(game_id, state_blob)
+        return cls.from_dict(game_id, json.loads(state_json))
+
+    def to_dict(self) -> Dict:
+        # همان state_json نسخه ۰؛ history جدا در جدول moves است
+        return {
+            "board": self.board.to_list(),
+            "current_player": self.current_player,
+            "game_type": self.game_type,
+            "players": {"X": self.player_x, "O": self.player_o},
+            "ai_difficulty": self.ai_difficulty,
+            "finished": self.finished,
+            "winner": self.winner,
+            "messages": {side: {"chat_id": msg[0], "message_id": msg[1]}
+                         for side, msg in (("X", self.message_x), ("O", self.message_o)) if msg},
+        }
+
+    def to_row(self, chat_id: int, message_id: Optional[int], last_activity: int) -> Tuple:
+        # ply پیش از صفحه خوانده می‌شود: حرکت همزمان در بازسازی دوباره اعمال می‌شود، نه گم
+        ply = self.ply
+        try:
+            state_json, state_blob, version = None, self.pack(), STATE_VERSION
+        except STATE_ENCODE_ERRORS:
+            # مقداری که در قالب باینری جا نمی‌شود؛ JSON نسخه ۰ نوشته می‌شود
+            state_json, state_blob, version = json.dumps(self.to_dict(), ensure_ascii=False), None, 0
+        return (
+            (self.game_id, chat_id, message_id or 0, state_json, state_blob, version, last_activity)
+            + game_index_columns(self, last_activity)
+            + (ply,)
+        )
+
+
+def new_game(game_type: str, creator_id: int, opponent_id: Optional[int] = None, ai_difficulty: Optional[str] = None,
+             game_id: Optional[str] = None) -> GameState:
+    return GameState(game_id, game_type, creator_id, opponent_id or None, ai_difficulty)
 
 
 def generate_game_id() -> str:
     return uuid.uuid4().hex[:12]
 
 
-def get_game_lock(game_id: str) -> threading.Lock:
-    with LOCK:
-        if game_id not in GAME_LOCKS:
-            GAME_LOCKS[game_id] = threading.Lock()
-        return GAME_LOCKS[game_id]
+def who_is_player(state: GameState, user_id: int) -> Optional[str]:
+    return state.role_of(user_id)
 
 
-def who_is_player(state: Dict, user_id: int) -> Optional[str]:
-    for k, v in state["players"].items():
-        if v == user_id:
-            return k
-    return None
+def check_winner(board) -> Optional[Tuple[str, List[int]]]:
+    bb = board if isinstance(board, Bitboard) else Bitboard.from_list(board)
+    return winner_bits(bb.x, bb.o)
+
+
+def is_draw(board) -> bool:
+    bb = board if isinstance(board, Bitboard) else Bitboard.from_list(board)
+    return bb.is_full()
+
+
+# ---------- game shards ----------
+GAME_SHARDS = 8
+
+
+class _Shard:
+    __slots__ = ("index", "tasks", "thread")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.tasks: "queue.SimpleQueue[Tuple[Callable, tuple, Future]]" = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+
+
+class GameShards:
+    # هر بازی بر اساس hash شناسه‌اش مال یک نخ است؛ کارهای یک بازی بی‌قفل و به ترتیب رسیدن اجرا می‌شوند
+    def __init__(self, count: int):
+        self._shards = [_Shard(i) for i in range(count)]
+        self._started = False
+        self._lock = threading.Lock()
 
+    def __len__(self) -> int:
+        return len(self._shards)
 
-def check_winner(board: List[str]) -> Optional[Tuple[str, List[int]]]:
-    for a, b, c in WIN_LINES:
-        if board[a] and board[a] == board[b] == board[c]:
-            return board[a], [a, b, c]
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for shard in self._shards:
+                shard.thread = threading.Thread(target=self._loop, args=(shard,), name=f"shard-{shard.index}", daemon=True)
+                shard.thread.start()
+
+    def shard_of(self, game_id: str) -> _Shard:
+        return self._shards[zlib.crc32(game_id.encode()) % len(self._shards)]
+
+    def submit(self, game_id: str, fn: Callable, *args) -> Future:
+        future: Future = Future()
+        self.shard_of(game_id).tasks.put((fn, args, future))
+        return future
+
+    def post(self, game_id: str, fn: Callable, *args):
+        self.submit(game_id, fn, *args).add_done_callback(_report_shard_error)
+
+    def run(self, game_id: str, fn: Callable, *args):
+        # روی نخ همان شارد مستقیم اجرا می‌شود تا منتظر خودش نماند
+        if self.shard_of(game_id).thread is threading.current_thread():
+            return fn(*args)
+        return self.submit(game_id, fn, *args).result()
+
+    def depth(self) -> int:
+        return sum(shard.tasks.qsize() for shard in self._shards)
+
+    @staticmethod
+    def _loop(shard: _Shard):
+        while True:
+            fn, args, future = shard.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def _report_shard_error(future: Future):
+    e = future.exception()
+    if e is not None:
+        print(f"Shard task error: {e}")
+
+
+SHARDS = GameShards(GAME_SHARDS)
+
+
+def game_actor(game_key: Callable):
+    # هندلر روی شارد بازی‌ای که game_key از آپدیت درمی‌آورد اجرا می‌شود؛ بدون بازی، همین‌جا
+    def decorator(handler):
+        @wraps(handler)
+        def dispatch(update):
+            try:
+                game_id = game_key(update)
+            except Exception:
+                game_id = None
+            if not game_id:
+                return handler(update)
+            timing = current_timing()
+            if timing is None:
+                SHARDS.post(game_id, handler, update)
+                return
+            timing.deferred = True
+            SHARDS.post(game_id, resume_timed, timing, handler, update)
+        return dispatch
+    return decorator
+
+
+def gid_suffix(call: types.CallbackQuery) -> str:
+    return call.data.rsplit("_", 1)[1]
+
+
+def gid_after_bar(call: types.CallbackQuery) -> str:
+    return call.data.split("|")[1]
+
+
+def gid_of_move(call: types.CallbackQuery) -> str:
+    return call.data.split("_", 1)[1].split("|")[0]
+
+
+def gid_of_join(message: types.Message) -> Optional[str]:
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) > 1 and parts[1].startswith("join_"):
+        return parts[1].split("_", 1)[1]
     return None
 
 
-def is_draw(board: List[str]) -> bool:
-    return all(cell in ["X", "O"] for cell in board)
+# ---------- outbound Telegram API ----------
+OUTBOX_GLOBAL_RATE = 30.0
+OUTBOX_CHAT_RATE = 1.0
+OUTBOX_CHAT_BURST = 3
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_CONTENT_MAX = 20000  # آخرین متن و markup هر پیام برای رد کردن ویرایش‌های بی‌تغییر
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready_at(self, now: float) -> float:
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outbound:
+    __slots__ = ("method", "chat_id", "message_id", "text", "kwargs", "on_done", "on_error", "attempts")
+
+    def __init__(self, method: str, chat_id: int, message_id: Optional[int], text: str, kwargs: Dict, on_done, on_error):
+        self.method = method
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.on_error = on_error
+        self.attempts = 0
+
+
+class _ChatQueue:
+    __slots__ = ("items", "bucket", "busy", "scheduled", "not_before")
+
+    def __init__(self, bucket: TokenBucket):
+        self.items: "deque[_Outbound]" = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.scheduled = False
+        self.not_before = 0.0
+
+
+def _serialize_markup(kwargs: Dict) -> Optional[str]:
+    # markup یک بار به JSON تبدیل می‌شود تا مقایسه محتوا و ارسال هر دو از همان رشته استفاده کنند
+    markup = kwargs.get("reply_markup")
+    if isinstance(markup, types.JsonSerializable):
+        markup = kwargs["reply_markup"] = markup.to_json()
+    return markup
+
+
+class Outbox:
+    # صف خروجی پیام‌ها: محدودیت سراسری و هر چت، عقب‌نشینی روی 429،
+    # و ادغام ویرایش‌های پشت سر هم یک پیام تا فقط آخرین بورد ارسال شود
+    def __init__(self, api, global_rate: float, chat_rate: float, chat_burst: int, workers: int):
+        self.api = api
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._edits: Dict[Tuple[int, int], _Outbound] = {}
+        self._content: "OrderedDict[Tuple[int, int], Tuple[str, Optional[str]]]" = OrderedDict()
+        self._ready: List[Tuple[float, int, int]] = []
+        self._seq = 0
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.unchanged = 0
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+                self._threads.append(t)
+                t.start()
+
+    def send_message(self, chat_id: int, text: str, on_done=None, on_error=None, **kwargs):
+        _serialize_markup(kwargs)
+        with self._cond:
+            self._push(_Outbound("send_message", chat_id, None, text, kwargs, on_done, on_error))
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, on_done=None, on_error=None, **kwargs):
+        key = (chat_id, message_id)
+        content = (text, _serialize_markup(kwargs))
+        with self._cond:
+            if self._content.get(key) == content:
+                # پیام همین الان (یا بعد از ارسال صف) همین متن و دکمه‌ها را دارد
+                self.unchanged += 1
+                return
+            self._remember(key, content)
+            queued = self._edits.get(key)
+            if queued is not None:
+                # نسخه قبلی هنوز ارسال نشده؛ همان جای صف با محتوای جدید پر می‌شود
+                queued.text = text
+                queued.kwargs = kwargs
+                queued.on_done = on_done
+                queued.on_error = on_error
+                self.coalesced += 1
+                return
+            req = _Outbound("edit_message_text", chat_id, message_id, text, kwargs, on_done, on_error)
+            self._edits[key] = req
+            self._push(req)
+
+    def answer_callback_query(self, callback_query_id: str, text: Optional[str] = None, on_done=None, on_error=None, **kwargs):
+        # جواب هر callback صف جدای خودش را دارد (کلید رشته‌ای، جدا از شناسه عددی چت‌ها)
+        # تا پشت ویرایش‌های همان چت منتظر نماند؛ فقط محدودیت سراسری رویش اعمال می‌شود
+        with self._cond:
+            self._push(_Outbound("answer_callback_query", callback_query_id, None, text, kwargs, on_done, on_error))
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._pending
+
+    def _remember(self, key: Tuple[int, int], content: Tuple[str, Optional[str]]):
+        self._content[key] = content
+        self._content.move_to_end(key)
+        if len(self._content) > OUTBOX_CONTENT_MAX:
+            self._content.popitem(last=False)
+
+    def _forget(self, req: _Outbound):
+        with self._cond:
+            self._content.pop((req.chat_id, req.message_id), None)
+
+    def chat_backlog(self, chat_id: int) -> int:
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            return len(chat.items) if chat is not None else 0
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _push(self, req: _Outbound):
+        chat = self._chats.get(req.chat_id)
+        if chat is None:
+            chat = self._chats[req.chat_id] = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.items.append(req)
+        self._pending += 1
+        self._schedule(req.chat_id, chat)
+        self._seq += 1
+        if self._seq % 1024 == 0:
+            self._reclaim()
+
+    def _reclaim(self):
+        now = time.monotonic()
+        for chat_id, chat in list(self._chats.items()):
+            if not (chat.items or chat.busy) and chat.not_before <= now and chat.bucket.full(now):
+                del self._chats[chat_id]
+
+    def _schedule(self, chat_id: int, chat: _ChatQueue):
+        if chat.busy or chat.scheduled or not chat.items:
+            return
+        now = time.monotonic()
+        due = max(chat.not_before, chat.bucket.ready_at(now))
+        self._seq += 1
+        heapq.heappush(self._ready, (due, self._seq, chat_id))
+        chat.scheduled = True
+        self._cond.notify()
+
+    def _next(self) -> Tuple[int, _ChatQueue, _Outbound]:
+        with self._cond:
+            while True:
+                wait = None
+                if self._ready:
+                    now = time.monotonic()
+                    due, _, chat_id = self._ready[0]
+                    wait = max(due, self._global.ready_at(now)) - now
+                    if wait <= 0:
+                        heapq.heappop(self._ready)
+                        chat = self._chats[chat_id]
+                        chat.scheduled = False
+                        req = chat.items.popleft()
+                        if self._edits.get((req.chat_id, req.message_id)) is req:
+                            del self._edits[(req.chat_id, req.message_id)]
+                        chat.busy = True
+                        chat.bucket.take(now)
+                        self._global.take(now)
+                        return chat_id, chat, req
+                self._cond.wait(wait)
+
+    def _finish(self, chat_id: int, chat: _ChatQueue, retry: Optional[_Outbound] = None, delay: float = 0.0):
+        with self._cond:
+            chat.busy = False
+            now = time.monotonic()
+            if delay:
+                chat.not_before = now + delay
+            key = (chat_id, retry.message_id) if retry is not None else None
+            if retry is not None and (retry.method != "edit_message_text" or key not in self._edits):
+                chat.items.appendleft(retry)
+                if retry.method == "edit_message_text":
+                    self._edits[key] = retry
+            else:
+                # اگر در این فاصله ویرایش تازه‌تری برای همان پیام آمده، تلاش دوباره لازم نیست
+                self._pending -= 1
+            if chat.items:
+                self._schedule(chat_id, chat)
+            elif isinstance(chat_id, str) or (chat.not_before <= now and chat.bucket.full(now)):
+                del self._chats[chat_id]
+            self._cond.notify_all()
+
+    def _call(self, req: _Outbound):
+        if req.method == "edit_message_text":
+            return self.api.edit_message_text(req.text, req.chat_id, req.message_id, **req.kwargs)
+        if req.method == "answer_callback_query":
+            return self.api.answer_callback_query(req.chat_id, req.text, **req.kwargs)
+        return self.api.send_message(req.chat_id, req.text, **req.kwargs)
+
+    def _run(self):
+        while True:
+            chat_id, chat, req = self._next()
+            req.attempts += 1
+            try:
+                result = self._call(req)
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    self.rate_limited += 1
+                    retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                    self._finish(chat_id, chat, req, delay=float(retry_after))
+                    continue
+                self._finish(chat_id, chat)
+                if "message is not modified" in str(e.description):
+                    continue
+                self._forget(req)
+                self._fail(req, e)
+                continue
+            except Exception as e:
+                if req.attempts < OUTBOX_MAX_ATTEMPTS:
+                    self._finish(chat_id, chat, req, delay=0.5 * req.attempts)
+                    continue
+                self._finish(chat_id, chat)
+                self._forget(req)
+                self._fail(req, e)
+                continue
+            self._finish(chat_id, chat)
+            self.sent += 1
+            if req.method == "send_message" and getattr(result, "message_id", None) is not None:
+                with self._cond:
+                    self._remember((req.chat_id, result.message_id), (req.text, req.kwargs.get("reply_markup")))
+            if req.on_done:
+                try:
+                    req.on_done(result)
+                except Exception as e:
+                    print(f"Outbox callback error: {e}")
+
+    def _fail(self, req: _Outbound, e: Exception):
+        self.failed += 1
+        if req.on_error:
+            try:
+                req.on_error(e)
+            except Exception as cb_error:
+                print(f"Outbox callback error: {cb_error}")
+        else:
+            print(f"{req.method} error: {e}")
+
+
+OUTBOX = Outbox(API, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_WORKERS)
+
+
+# ---------- timers & animations ----------
+ANIM_SKIP_BACKLOG = 200
+ANIM_SKIP_CHAT_BACKLOG = 2
+
+
+class TimerHandle:
+    __slots__ = ("when", "fn", "args", "cancelled")
+
+    def __init__(self, when: float, fn, args: Tuple):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler:
+    # یک نخ برای همه کارهای زمان‌دار کوتاه، به جای یک نخ خوابیده برای هر کار
+    def __init__(self, name: str):
+        self.name = name
+        self._heap: List[Tuple[float, int, TimerHandle]] = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def call_later(self, delay: float, fn, *args) -> TimerHandle:
+        handle = TimerHandle(time.monotonic() + delay, fn, args)
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (handle.when, self._seq, handle))
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    handle = heapq.heappop(self._heap)[2]
+                    break
+            if handle.cancelled:
+                continue
+            try:
+                handle.fn(*handle.args)
+            except Exception as e:
+                print(f"{self.name} task error: {e}")
+
+
+class _Animation:
+    __slots__ = ("chat_id", "message_id", "frames", "index", "final", "cleanup")
+
+    def __init__(self, chat_id: int, message_id: Optional[int], frames: List, final, cleanup):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.frames = frames
+        self.index = 0
+        self.final = final
+        self.cleanup = cleanup
+
+
+class AnimationEngine:
+    # فریم‌ها روی تایمر مشترک پخش می‌شوند؛ وقتی صف خروجی شلوغ است فریم‌های میانی
+    # رد می‌شوند ولی فریم نهایی و cleanup همیشه اجرا می‌شوند
+    def __init__(self, timers: TimerScheduler, outbox: Outbox, skip_backlog: int, skip_chat_backlog: int):
+        self.timers = timers
+        self.outbox = outbox
+        self.skip_backlog = skip_backlog
+        self.skip_chat_backlog = skip_chat_backlog
+        self.active = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def play(self, chat_id: int, message_id: Optional[int], frames: List, final, cleanup):
+        with self._lock:
+            self.active += 1
+        self.timers.call_later(0, self._step, _Animation(chat_id, message_id, frames, final, cleanup))
+
+    def _congested(self, chat_id: int) -> bool:
+        return self.outbox.pending() > self.skip_backlog or self.outbox.chat_backlog(chat_id) > self.skip_chat_backlog
+
+    def _step(self, anim: _Animation):
+        if anim.index < len(anim.frames):
+            if self._congested(anim.chat_id):
+                self.skipped += len(anim.frames) - anim.index
+                anim.index = len(anim.frames)
+            else:
+                render, delay = anim.frames[anim.index]
+                anim.index += 1
+                try:
+                    text, markup = render()
+                    self.outbox.edit_message_text(text, anim.chat_id, anim.message_id, reply_markup=markup)
+                    self.timers.call_later(delay, self._step, anim)
+                    return
+                except Exception as e:
+                    print(f"Animation error: {e}")
+                    anim.index = len(anim.frames)
+        self._finish(anim)
+
+    def _finish(self, anim: _Animation):
+        try:
+            text, markup = anim.final()
+            if anim.message_id:
+                self.outbox.edit_message_text(text, anim.chat_id, anim.message_id, reply_markup=markup)
+            else:
+                self.outbox.send_message(anim.chat_id, text, reply_markup=markup)
+        except Exception as e:
+            print(f"Animation error: {e}")
+        finally:
+            with self._lock:
+                self.active -= 1
+            anim.cleanup()
+
+
+TIMERS = TimerScheduler("timers")
+ANIMATIONS = AnimationEngine(TIMERS, OUTBOX, ANIM_SKIP_BACKLOG, ANIM_SKIP_CHAT_BACKLOG)
+
+
+# ---------- AI move queue ----------
+AI_THINK_SECONDS = 1.0
+AI_WORKERS = 4
+AI_QUEUE_LIMIT = 256
+AI_RETRY_DELAY = 0.2
+
+
+class _AiTask:
+    __slots__ = ("game_id", "cancelled", "timer")
+
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        self.cancelled = False
+        self.timer: Optional[TimerHandle] = None
+
+
+class AiMoveQueue:
+    # مکث «در حال فکر» روی تایمر مشترک است و خود حرکت در یک استخر محدود اجرا می‌شود
+    def __init__(self, timers: TimerScheduler, workers: int, limit: int, think_delay: float):
+        self.timers = timers
+        self.think_delay = think_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai")
+        self._slots = threading.BoundedSemaphore(limit)
+        self._tasks: Dict[str, _AiTask] = {}
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.deferred = 0
+
+    def submit(self, game_id: str):
+        task = _AiTask(game_id)
+        with self._lock:
+            old = self._tasks.get(game_id)
+            if old is not None:
+                self._cancel(old)
+            self._tasks[game_id] = task
+            self.waiting += 1
+            # زیر همان قفل: cancel همزمان باید تایمر را ببیند تا waiting را کم کند
+            task.timer = self.timers.call_later(self.think_delay, self._dispatch, task)
+
+    def cancel(self, game_id: str):
+        with self._lock:
+            task = self._tasks.get(game_id)
+            if task is not None:
+                self._cancel(task)
+
+    def _cancel(self, task: _AiTask):
+        task.cancelled = True
+        self.cancelled += 1
+        if self._tasks.get(task.game_id) is task:
+            del self._tasks[task.game_id]
+        if task.timer is not None:
+            task.timer.cancel()
+            self.waiting -= 1
+            task.timer = None
+
+    def _dispatch(self, task: _AiTask):
+        with self._lock:
+            if task.cancelled:
+                return
+            if not self._slots.acquire(blocking=False):
+                # استخر پر است؛ حرکت رد نمی‌شود و کمی بعد دوباره امتحان می‌شود (بازی AI بدون جواب گیر می‌کرد).
+                # سقف واقعی همان _slots است؛ کار منتظر فقط یک ورودی تایمر است
+                self.deferred += 1
+                task.timer = self.timers.call_later(AI_RETRY_DELAY, self._dispatch, task)
+                return
+            task.timer = None
+            self.waiting -= 1
+            self.queued += 1
+        self._executor.submit(self._run, task)
+
+    def _run(self, task: _AiTask):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            if not task.cancelled:
+                do_ai_move(task.game_id)
+        except Exception as e:
+            print(f"AI move error: {e}")
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                if self._tasks.get(task.game_id) is task:
+                    del self._tasks[task.game_id]
+
+    def depth(self) -> Dict[str, int]:
+        with self._lock:
+            return {"waiting": self.waiting, "queued": self.queued, "running": self.running}
+
+
+AI_MOVES = AiMoveQueue(TIMERS, AI_WORKERS, AI_QUEUE_LIMIT, AI_THINK_SECONDS)
+
+
+# ---------- speculative AI replies ----------
+AI_SPECULATE = True
+AI_SPECULATION_BUDGET = 0.25  # ثانیه CPU برای هر نوبت
+AI_SPECULATION_WORKERS = 1
+AI_SPECULATION_MAX_GAMES = 10000
+AI_SPECULATION_BACKLOG = 64
+
+
+class _Speculation:
+    __slots__ = ("replies", "stopped")
+
+    def __init__(self):
+        self.replies: Dict[int, int] = {}
+        self.stopped = False
+
+
+class Speculator:
+    # وقتی نوبت آدم است، جواب AI به هر حرکت ممکنش از قبل حساب می‌شود
+    def __init__(self, workers: int, budget: float, max_games: int, backlog: int):
+        self.budget = budget
+        self.max_games = max_games
+        self.backlog = backlog
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculate")
+        self._games: "OrderedDict[str, _Speculation]" = OrderedDict()
+        self._running = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+
+    def start(self, game_id: str, board: Bitboard, difficulty: Optional[str]):
+        if not AI_SPECULATE:
+            return
+        spec = _Speculation()
+        with self._lock:
+            old = self._games.pop(game_id, None)
+            if old is not None:
+                old.stopped = True
+            if self._running >= self.backlog:
+                self.dropped += 1
+                return
+            self._games[game_id] = spec
+            while len(self._games) > self.max_games:
+                self._games.popitem(last=False)[1].stopped = True
+            self._running += 1
+        self._executor.submit(self._run, spec, Bitboard(board.x, board.o), difficulty)
+
+    def _run(self, spec: _Speculation, bb: Bitboard, difficulty: Optional[str]):
+        try:
+            started = time.thread_time()
+            for pos in bb.legal_moves():
+                if spec.stopped or time.thread_time() - started > self.budget:
+                    break
+                x = bb.x | 1 << pos
+                if wins_through(x, pos) or (x | bb.o) == FULL_MASK:
+                    continue
+                # جست‌وجو در همین پروسه انجام می‌شود تا جواب کم‌عمق fallback ذخیره نشود
+                reply = ai_choose_move(Bitboard(x, bb.o), difficulty, offload=False)
+                spec.replies[x | bb.o << 9] = reply
+        except Exception as e:
+            print(f"Speculation error: {e}")
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def stop(self, game_id: str):
+        with self._lock:
+            spec = self._games.get(game_id)
+            if spec is not None:
+                spec.stopped = True
+
+    def cancel(self, game_id: str):
+        with self._lock:
+            spec = self._games.pop(game_id, None)
+            if spec is not None:
+                spec.stopped = True
+
+    def take(self, game_id: str, board: Bitboard) -> Optional[int]:
+        with self._lock:
+            spec = self._games.pop(game_id, None)
+        if spec is None:
+            return None
+        spec.stopped = True
+        reply = spec.replies.get(PerfectPlayTable.key(board))
+        if reply is None or board[reply]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return reply
+
+
+SPECULATOR = Speculator(AI_SPECULATION_WORKERS, AI_SPECULATION_BUDGET, AI_SPECULATION_MAX_GAMES, AI_SPECULATION_BACKLOG)
 
 
 # ---------- UI helpers ----------
+PROFILE_TTL = 6 * 3600
+PROFILE_NEGATIVE_TTL = 10 * 60
+PROFILE_CACHE_MAX = 50000
+PROFILE_LOOKUP_WORKERS = 2  # get_chat/get_me پس‌زمینه، بیرون از نخ‌های شارد و تایمر
+
+
+def display_name(first_name: Optional[str], username: Optional[str]) -> Optional[str]:
+    if first_name:
+        return first_name
+    if username:
+        return f"@{username}"
+    return None
+
+
+class ProfileCache:
+    # اسم بازیکن‌ها از خود آپدیت‌ها یاد گرفته می‌شود؛ get_chat فقط وقتی اسم را نداریم و در پس‌زمینه
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float, workers: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._names: "OrderedDict[int, Tuple[Optional[str], float]]" = OrderedDict()
+        self._fetching: Set[int] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookup")
+
+    def _store(self, user_id: int, name: Optional[str], ttl: float):
+        with self._lock:
+            self._names[user_id] = (name, time.monotonic() + ttl)
+            self._names.move_to_end(user_id)
+            if len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def remember(self, user):
+        if user is None or not isinstance(getattr(user, "id", None), int):
+            return
+        name = display_name(getattr(user, "first_name", None), getattr(user, "username", None))
+        if name:
+            self._store(user.id, name, self.ttl)
+
+    def lookup(self, user_id: int) -> Tuple[bool, Optional[str]]:
+        with self._lock:
+            cached = self._names.get(user_id)
+            if cached is None:
+                return False, None
+            name, expires = cached
+            if expires < time.monotonic():
+                del self._names[user_id]
+                return False, None
+            return True, name
+
+    def name(self, user_id: int) -> Optional[str]:
+        # بدون انتظار: اگر اسم را نداریم get_chat در پس‌زمینه می‌رود و این بار None برمی‌گردد
+        found, name = self.lookup(user_id)
+        if found:
+            return name
+        with self._lock:
+            if user_id in self._fetching:
+                return None
+            self._fetching.add(user_id)
+        self._executor.submit(self.fetch, user_id)
+        return None
+
+    def fetch(self, user_id: int) -> Optional[str]:
+        try:
+            chat = API.get_chat(user_id)
+            name = display_name(getattr(chat, "first_name", None), getattr(chat, "username", None))
+        except Exception:
+            name = None
+        self._store(user_id, name, self.ttl if name else self.negative_ttl)
+        with self._lock:
+            self._fetching.discard(user_id)
+        return name
+
+    def background(self, fn, *args) -> Future:
+        return self._executor.submit(fn, *args)
+
+
+PROFILES = ProfileCache(PROFILE_CACHE_MAX, PROFILE_TTL, PROFILE_NEGATIVE_TTL, PROFILE_LOOKUP_WORKERS)
+_BOT_USERNAME: Optional[str] = None
+_BOT_USERNAME_LOOKUP: Optional[Future] = None
+
+
+@bot.middleware_handler(update_types=["message", "callback_query"])
+def learn_profiles(bot_instance, update):
+    PROFILES.remember(update.from_user)
+
+
+def load_bot_username() -> Optional[str]:
+    # تماس get_me با انتظار؛ فقط موقع راه‌اندازی یا در پس‌زمینه
+    global _BOT_USERNAME
+    if _BOT_USERNAME is None:
+        try:
+            _BOT_USERNAME = API.get_me().username
+        except Exception as e:
+            print(f"get_me error: {e}")
+    return _BOT_USERNAME
+
+
+def bot_username() -> Optional[str]:
+    # روی نخ شارد صدا زده می‌شود؛ اگر هنوز نداریم، get_me در پس‌زمینه و این بار None
+    global _BOT_USERNAME_LOOKUP
+    if _BOT_USERNAME is None and (_BOT_USERNAME_LOOKUP is None or _BOT_USERNAME_LOOKUP.done()):
+        _BOT_USERNAME_LOOKUP = PROFILES.background(load_bot_username)
+    return _BOT_USERNAME
+
+
 def safe_get_username(user_id: Optional[int]) -> str:
     if not isinstance(user_id, int):
         return "منتظر بازیکن"
-    try:
-        chat = bot.get_chat(user_id)
-        if getattr(chat, "first_name", None):
-            return chat.first_name
-        if getattr(chat, "username", None):
-            return f"@{chat.username}"
-    except Exception:
-        pass
-    return f"کاربر #{user_id}"
-
-
-def render_board(state: Dict, highlight: Optional[List[int]] = None, anim_emoji: str = None) -> Tuple[str, types.InlineKeyboardMarkup]:
-    board = state["board"]
-    turn = state["current_player"]
-    x_name = safe_get_username(state["players"].get("X"))
-    o_name = safe_get_username(state["players"].get("O"))
-    
-    header = (
+    return PROFILES.name(user_id) or f"کاربر #{user_id}"
+
+
+RENDER_CACHE_MAX = 50000
+
+
+class RenderCache:
+    # markup سریال‌شده هر وضعیت صفحه و header هر بازی یک بار ساخته و بین همه مقصدها و فریم‌ها شریک می‌شود
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._markups: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._headers: "OrderedDict[str, Tuple[Tuple, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def markup(self, key: Tuple, build: Callable[[], str]) -> str:
+        with self._lock:
+            cached = self._markups.get(key)
+            if cached is not None:
+                self._markups.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        built = build()
+        with self._lock:
+            self._markups[key] = built
+            if len(self._markups) > self.max_size:
+                self._markups.popitem(last=False)
+        return built
+
+    def header(self, game_id: str, key: Tuple, build: Callable[[], str]) -> str:
+        with self._lock:
+            cached = self._headers.get(game_id)
+            if cached is not None and cached[0] == key:
+                self._headers.move_to_end(game_id)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        built = build()
+        with self._lock:
+            self._headers[game_id] = (key, built)
+            self._headers.move_to_end(game_id)
+            if len(self._headers) > self.max_size:
+                self._headers.popitem(last=False)
+        return built
+
+
+RENDERS = RenderCache(RENDER_CACHE_MAX)
+
+
+def _board_header(turn: str, name_x: str, name_o: str, ply: int) -> str:
+    return (
         f"🎮 بازی دوز | نوبت: {'بازیکن X' if turn == 'X' else 'بازیکن O'}\n"
-        f"🔷 بازیکن X: {x_name}\n"
-        f"🔶 بازیکن O: {o_name}\n"
-        f"📊 حرکات: {len(state.get('history', []))}"
+        f"🔷 بازیکن X: {name_x}\n"
+        f"🔶 بازیکن O: {name_o}\n"
+        f"📊 حرکات: {ply}"
     )
-    
+
+
+def _board_markup(gid: str, x: int, o: int, highlight: int, highlight_label: str, inviter: Optional[str]) -> str:
     kb = types.InlineKeyboardMarkup(row_width=3)
     btns = []
     for i in range(9):
-        val = board[i]
-        if val == "X":
+        if highlight >> i & 1:
+            label = highlight_label
+        elif x >> i & 1:
             label = EMOJI_X
-        elif val == "O":
+        elif o >> i & 1:
             label = EMOJI_O
         else:
             label = EMOJI_EMPTY
-        
-        if highlight and i in highlight:
-            label = anim_emoji or random.choice(WIN_ANIM)
-        cb = f"move_{state.get('_id','')}|{i}"
-        btns.append(types.InlineKeyboardButton(label, callback_data=cb))
+        btns.append(types.InlineKeyboardButton(label, callback_data=f"move_{gid}|{i}"))
     
     kb.row(btns[0], btns[1], btns[2])
     kb.row(btns[3], btns[4], btns[5])
     kb.row(btns[6], btns[7], btns[8])
 
     action_row = []
-    action_row.append(types.InlineKeyboardButton("🔄 ریست بازی", callback_data=f"restart_{state.get('_id','')}"))
-    action_row.append(types.InlineKeyboardButton("🏳️ تسلیم", callback_data=f"forfeit_{state.get('_id','')}"))
-    action_row.append(types.InlineKeyboardButton("🔁 رفرش بورد", callback_data=f"refresh_{state.get('_id','')}"))
+    action_row.append(types.InlineKeyboardButton("🔄 ریست بازی", callback_data=f"restart_{gid}"))
+    action_row.append(types.InlineKeyboardButton("🏳️ تسلیم", callback_data=f"forfeit_{gid}"))
+    action_row.append(types.InlineKeyboardButton("🔁 رفرش بورد", callback_data=f"refresh_{gid}"))
     kb.row(*action_row)
 
-    if state.get("game_type") == "pvp" and not state.get("finished"):
-        try:
-            me = bot.get_me()
-            gid = state.get("_id", "")
-            invite_url = f"https://t.me/{me.username}?start=join_{gid}"
-            kb.row(types.InlineKeyboardButton("📩 دعوت از دوست", url=invite_url))
-        except Exception:
-            pass
+    if inviter:
+        invite_url = f"https://t.me/{inviter}?start=join_{gid}"
+        kb.row(types.InlineKeyboardButton("📩 دعوت از دوست", url=invite_url))
+
+    return kb.to_json()
+
+
+def render_board(state: GameState, highlight: Optional[List[int]] = None, anim_emoji: str = None) -> Tuple[str, str]:
+    # markup به شکل JSON برمی‌گردد؛ telebot رشته را بدون تبدیل دوباره می‌فرستد
+    gid = state.game_id or ""
+    board = state.board
+    x, o = board.x, board.o
+    mask = sum(1 << i for i in highlight) if highlight else 0
+    label = (anim_emoji or random.choice(WIN_ANIM)) if mask else ""
+    # یوزرنیم بات جزو کلید است؛ markup ساخته‌شده بدون دکمه دعوت (get_me هنوز جواب نداده) بعد از رسیدنش دوباره ساخته می‌شود
+    inviter = bot_username() if state.game_type == "pvp" and not state.finished else None
+    markup = RENDERS.markup((gid, x, o, mask, label, inviter), partial(_board_markup, gid, x, o, mask, label, inviter))
+    # اسم‌ها بدون انتظار خوانده می‌شوند و جزو کلیدند، تا اسمی که بعداً از get_chat برسد header را تازه کند
+    turn, ply = state.current_player, state.ply
+    name_x, name_o = safe_get_username(state.player_x), safe_get_username(state.player_o)
+    header = RENDERS.header(gid, (turn, name_x, name_o, ply), partial(_board_header, turn, name_x, name_o, ply))
+    return header, markup
+
+
+def _stored_board(state: GameState, side: str) -> Optional[Tuple[int, int]]:
+    msginfo = state.message(side)
+    if msginfo and msginfo[0] and msginfo[1]:
+        return msginfo[0], msginfo[1]
+    return None
+
+
+def _primary_owner(state: GameState, primary: Tuple[int, int]) -> str:
+    # پیام اصلی بازی مال کیست: اول پیام ذخیره‌شده هر طرف، بعد صاحب چت؛ چت مشترک (گروه) مال سازنده است
+    for side in ("X", "O"):
+        if _stored_board(state, side) == primary:
+            return side
+    for side in ("X", "O"):
+        if state.player(side) == primary[0]:
+            return side
+    return "X"
+
+
+def board_targets(state: GameState, chat_id: int, message_id: Optional[int]) -> List[Tuple[str, int, Optional[int]]]:
+    # پیام‌های متمایز بورد: (side, chat_id, message_id)؛ پیام اصلی فقط برای صاحبش و فقط وقتی بورد خودش را ندارد
+    primary = (chat_id, message_id) if message_id else None
+    owner = _primary_owner(state, primary) if primary else None
+    targets = []
+    seen = set()
+    for side in ("X", "O"):
+        user_id = state.player(side)
+        if not isinstance(user_id, int):
+            continue
+        key = _stored_board(state, side)
+        if key is None:
+            key = primary if side == owner else (user_id, None)
+        if key in seen:
+            continue
+        seen.add(key)
+        targets.append((side, key[0], key[1]))
+    # پیام اصلی‌ای که صاحبش بورد تازه‌تری دارد کنار گذاشته می‌شود؛ ویرایش آن اگر پاک شده باشد هر حرکت بورد تکراری می‌ساخت
+    return targets
+
+
+def fan_out_board(gid: str, state: GameState, chat_id: int, message_id: Optional[int], text: str, markup: str):
+    # هر مقصد یک بار؛ Outbox آخرین محتوای هر پیام را نگه می‌دارد و ویرایش بی‌تغییر را نمی‌فرستد
+    for side, target_chat, target_message in board_targets(state, chat_id, message_id):
+        if target_message is None:
+            resend_board(gid, side, target_chat, text, markup)
+            continue
+        OUTBOX.edit_message_text(
+            text,
+            target_chat,
+            target_message,
+            reply_markup=markup,
+            on_error=lambda e, side=side, target_chat=target_chat: resend_board(gid, side, target_chat, text, markup),
+        )
+
 
-    return header, kb
+def resend_board(gid: str, side: str, target_chat: int, text: str, markup: str):
+    # مسیر بازیابی: فقط یک پیام تازه که نشانی بورد همان طرف در بازی می‌شود
+    def relink(msg):
+        SHARDS.post(gid, relink_board_message, gid, side, target_chat, msg.message_id)
 
+    OUTBOX.send_message(
+        target_chat,
+        text,
+        reply_markup=markup,
+        on_done=relink,
+        on_error=lambda e: print(f"Board resend error: {e}"),
+    )
+
+
+def relink_board_message(gid: str, side: str, target_chat: int, target_message: int):
+    loaded = load_game(gid)
+    if not loaded:
+        return
+    state = loaded[2]
+    state.set_message(side, target_chat, target_message)
+    GAME_CACHE.mark_dirty(gid)
+
+
+
+# ---------- transposition table ----------
+def _symmetry(f) -> Tuple[int, ...]:
+    return tuple(3 * f(i // 3, i % 3)[0] + f(i // 3, i % 3)[1] for i in range(9))
+
+
+# SYM_DEST[s][i]: خانه i بعد از تقارن s به کجا می‌رود (چهار چرخش و چهار قرینه)
+SYM_DEST = tuple(_symmetry(f) for f in (
+    lambda r, c: (r, c),
+    lambda r, c: (c, 2 - r),
+    lambda r, c: (2 - r, 2 - c),
+    lambda r, c: (2 - c, r),
+    lambda r, c: (r, 2 - c),
+    lambda r, c: (2 - r, c),
+    lambda r, c: (c, r),
+    lambda r, c: (2 - c, 2 - r),
+))
+SYM_INVERSE = tuple(tuple(dest.index(i) for i in range(9)) for dest in SYM_DEST)
+SYM_MASKS = tuple(
+    tuple(sum(1 << dest[i] for i in range(9) if mask >> i & 1) for mask in range(FULL_MASK + 1))
+    for dest in SYM_DEST
+)
+
+
+def canonical_key(ai: int, human: int, is_max: bool) -> Tuple[int, int]:
+    best = -1
+    best_sym = 0
+    for sym, table in enumerate(SYM_MASKS):
+        k = table[ai] | table[human] << 9
+        if best < 0 or k < best:
+            best = k
+            best_sym = sym
+    return best << 1 | is_max, best_sym
+
+
+TT_EXACT, TT_LOWER, TT_UPPER = 0, 1, 2
+TT_MAX_ENTRIES = 200000
+
+
+class TranspositionTable:
+    # مشترک بین همه بازی‌های پروسه؛ کلید شکل کانونی موقعیت است
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[int, int, int, Optional[int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: int) -> Optional[Tuple[int, int, int, Optional[int]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: int, entry: Tuple[int, int, int, Optional[int]]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+TRANSPOSITIONS = TranspositionTable(TT_MAX_ENTRIES)
 
 
 def minimax_ab(board: List[str], depth: int, is_max: bool, ai_player: str, human_player: str, alpha: int, beta: int) -> Tuple[int, Optional[int]]:
-    winner = check_winner(board)
-    if winner:
-        winp = winner[0]
-        if winp == ai_player:
-            return 10 + depth, None
-        elif winp == human_player:
-            return -10 - depth, None
-    if is_draw(board) or depth == 0:
+    bb = Bitboard.from_list(board)
+    ai_bits, human_bits = (bb.x, bb.o) if ai_player == "X" else (bb.o, bb.x)
+    return _minimax_bits(ai_bits, human_bits, depth, is_max, alpha, beta)
+
+
+def _minimax_bits(ai: int, human: int, depth: int, is_max: bool, alpha: int, beta: int) -> Tuple[int, Optional[int]]:
+    if line_mask(ai):
+        return 10 + depth, None
+    if line_mask(human):
+        return -10 - depth, None
+    occupied = ai | human
+    if occupied == FULL_MASK or depth == 0:
         return 0, None
 
+    key, sym = canonical_key(ai, human, is_max)
+    alpha0, beta0 = alpha, beta
+    moves = legal_moves(occupied)
+    entry = TRANSPOSITIONS.get(key)
+    if entry is not None:
+        e_depth, e_flag, e_value, e_move = entry
+        move = SYM_INVERSE[sym][e_move] if e_move is not None else None
+        if e_depth == depth:
+            if e_flag == TT_EXACT:
+                return e_value, move
+            if e_flag == TT_LOWER:
+                alpha = max(alpha, e_value)
+            else:
+                beta = min(beta, e_value)
+            if alpha >= beta:
+                return e_value, move
+        if move is not None:
+            # بهترین حرکت جست‌وجوی قبلی اول امتحان می‌شود تا برش زودتر رخ دهد
+            moves.remove(move)
+            moves.insert(0, move)
+
+    value, best_move = _minimax_children(ai, human, moves, depth, is_max, alpha, beta)
+    if value <= alpha0:
+        flag = TT_UPPER
+    elif value >= beta0:
+        flag = TT_LOWER
+    else:
+        flag = TT_EXACT
+    TRANSPOSITIONS.put(key, (depth, flag, value, SYM_DEST[sym][best_move] if best_move is not None else None))
+    return value, best_move
+
+
+def _minimax_children(ai: int, human: int, moves: List[int], depth: int, is_max: bool, alpha: int, beta: int) -> Tuple[int, Optional[int]]:
     best_move = None
     if is_max:
         value = -9999
-        for i in range(9):
-            if not board[i]:
-                board[i] = ai_player
-                v, _ = minimax_ab(board, depth - 1, False, ai_player, human_player, alpha, beta)
-                board[i] = ""
-                if v > value:
-                    value = v
-                    best_move = i
-                alpha = max(alpha, value)
-                if alpha >= beta:
-                    break
+        for i in moves:
+            v, _ = _minimax_bits(ai | 1 << i, human, depth - 1, False, alpha, beta)
+            if v > value:
+                value = v
+                best_move = i
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
         return value, best_move
     else:
         value = 9999
-        for i in range(9):
-            if not board[i]:
-                board[i] = human_player
-                v, _ = minimax_ab(board, depth - 1, True, ai_player, human_player, alpha, beta)
-                board[i] = ""
-                if v < value:
-                    value = v
-                    best_move = i
-                beta = min(beta, value)
-                if alpha >= beta:
-                    break
+        for i in moves:
+            v, _ = _minimax_bits(ai, human | 1 << i, depth - 1, True, alpha, beta)
+            if v < value:
+                value = v
+                best_move = i
+            beta = min(beta, value)
+            if alpha >= beta:
+                break
         return value, best_move
 
 
-def ai_choose_move(state: Dict) -> int:
-    board = state["board"][:]
-    difficulty = state.get("ai_difficulty", "medium")
-    valid = [i for i, v in enumerate(board) if v == ""]
-    ai_player = "O"
-    human_player = "X"
+# سطح‌ها انحراف کنترل‌شده از بازی کامل‌اند: (احتمال اشتباه، افق حرکت‌هایی که حتماً دیده می‌شوند)
+AI_LEVELS: Dict[str, Tuple[float, int]] = {
+    "easy": (0.75, 0),
+    "medium": (0.3, 2),
+    "hard": (0.0, 0),
+}
+AI_ENGINE = "table"  # "table" یا "search"
+
+
+class PerfectPlayTable:
+    # همه موقعیت‌های قابل‌دسترس دوز یک بار حل می‌شوند و هر حرکت AI یک lookup است
+    def __init__(self):
+        self._scores: Dict[int, Dict[int, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(board) -> int:
+        bb = board if isinstance(board, Bitboard) else Bitboard.from_list(board)
+        return bb.x | bb.o << 9
+
+    def build(self):
+        with self._lock:
+            if self._scores:
+                return
+            scores: Dict[int, Dict[int, int]] = {}
+            self._solve(0, 0, scores)
+            self._scores = scores
+
+    def _solve(self, me: int, them: int, scores: Dict[int, Dict[int, int]]) -> int:
+        # me همیشه مهره‌های بازیکنِ در نوبت است؛ کلید جدول اما بر حسب X و O است
+        x_to_move = bin(me).count("1") == bin(them).count("1")
+        key = me | them << 9 if x_to_move else them | me << 9
+        known = scores.get(key)
+        if known is not None:
+            return max(known.values())
+        empties = legal_moves(me | them)
+        moves = {}
+        for i in empties:
+            played = me | 1 << i
+            if wins_through(played, i):
+                moves[i] = 10 + len(empties) - 1
+            elif len(empties) == 1:
+                moves[i] = 0
+            else:
+                moves[i] = -self._solve(them, played, scores)
+        scores[key] = moves
+        return max(moves.values())
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def move_scores(self, board) -> Optional[Dict[int, int]]:
+        if not self._scores:
+            self.build()
+        return self._scores.get(self.key(board))
+
+    def choose(self, board, difficulty: Optional[str]) -> Optional[int]:
+        moves = self.move_scores(board)
+        if not moves:
+            return None
+        best = max(moves.values())
+        rate, horizon = AI_LEVELS.get(difficulty or "medium", AI_LEVELS["medium"])
+        if rate and random.random() < rate:
+            # امتیاز باختی که ظرف horizon حرکت رخ دهد از این کف پایین‌تر است
+            floor = -(10 + len(moves) - horizon) if horizon else None
+            candidates = [m for m, v in moves.items() if v < best and (floor is None or v > floor)]
+            if candidates:
+                return random.choice(candidates)
+        return random.choice([m for m, v in moves.items() if v == best])
+
+
+PERFECT_PLAY = PerfectPlayTable()
+
+
+def ai_choose_move(board: Bitboard, difficulty: Optional[str], offload: bool = True) -> int:
+    if AI_ENGINE == "table":
+        move = PERFECT_PLAY.choose(board, difficulty)
+        if move is not None:
+            return move
+    return search_ai_move(board, difficulty, offload)
+
+
+def search_ai_move(bb: Bitboard, difficulty: Optional[str], offload: bool = True) -> int:
+    difficulty = difficulty or "medium"
+    valid = bb.legal_moves()
     
     if difficulty == "easy":
         return random.choice(valid)
-    elif difficulty == "medium":
-        _, move = minimax_ab(board, depth=3, is_max=True, ai_player=ai_player, human_player=human_player, alpha=-9999, beta=9999)
-        return move if move is not None else random.choice(valid)
-    elif difficulty == "hard":
-        depth = sum(1 for c in board if c == "")
-        _, move = minimax_ab(board, depth=depth, is_max=True, ai_player=ai_player, human_player=human_player, alpha=-9999, beta=9999)
-        return move if move is not None else random.choice(valid)
-    else:
-        _, move = minimax_ab(board, depth=3, is_max=True, ai_player=ai_player, human_player=human_player, alpha=-9999, beta=9999)
-        return move if move is not None else random.choice(valid)
+    depth = len(valid) if difficulty == "hard" else 3
+    _, move = ai_search(bb.o, bb.x, depth, offload)
+    return move if move is not None else random.choice(valid)
+
+
+# ---------- process-pool search ----------
+AI_PROCESS_POOL = False  # جست‌وجوی minimax در پروسه‌های جدا، بیرون از GIL نخ‌های بات
+AI_PROCESS_WORKERS = 2
+AI_SEARCH_BUDGET = 2.0
+AI_FALLBACK_DEPTH = 2
+
+
+def _init_search_worker():
+    # هر پروسه جدول جابه‌جایی خالی خودش را دارد
+    global TRANSPOSITIONS
+    TRANSPOSITIONS = TranspositionTable(TT_MAX_ENTRIES)
+
+
+def _search_worker(packed: int, depth: int) -> Tuple[int, Optional[int]]:
+    return _minimax_bits(packed & FULL_MASK, packed >> 9, depth, True, -9999, 9999)
+
+
+class SearchPool:
+    def __init__(self, workers: int, budget: float):
+        self.workers = workers
+        self.budget = budget
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.offloaded = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            # fork از پروسه‌ای که نخ دارد (شارد، outbox، نوشتن گروهی) ممکن است قفلی در دست نخ دیگر را به ارث بدهد؛
+            # forkserver پروسه‌ها را از یک پروسه تمیز بی‌نخ می‌سازد، حتی کارگری که بعداً جایگزین می‌شود
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            ctx = multiprocessing.get_context(method)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=_init_search_worker)
+        # هزینه بالا آمدن پروسه‌ها همین حالا پرداخت شود، نه روی اولین حرکت AI
+        self._executor.submit(_search_worker, 0, 0).result()
+
+    def _release(self, _future):
+        with self._lock:
+            self._inflight -= 1
+
+    def search(self, ai: int, human: int, depth: int) -> Tuple[int, Optional[int]]:
+        with self._lock:
+            saturated = self._executor is None or self._inflight >= self.workers
+            if not saturated:
+                self._inflight += 1
+        if saturated:
+            self.fallbacks += 1
+            return _minimax_bits(ai, human, min(depth, AI_FALLBACK_DEPTH), True, -9999, 9999)
+        future = self._executor.submit(_search_worker, ai | human << 9, depth)
+        future.add_done_callback(self._release)
+        self.offloaded += 1
+        try:
+            return future.result(timeout=self.budget)
+        except FuturesTimeout:
+            self.timeouts += 1
+        except Exception as e:
+            print(f"AI search error: {e}")
+        self.fallbacks += 1
+        return _minimax_bits(ai, human, min(depth, AI_FALLBACK_DEPTH), True, -9999, 9999)
+
+
+SEARCH_POOL = SearchPool(AI_PROCESS_WORKERS, AI_SEARCH_BUDGET)
+
+
+def ai_search(ai: int, human: int, depth: int, offload: bool = True) -> Tuple[int, Optional[int]]:
+    if AI_PROCESS_POOL and offload:
+        return SEARCH_POOL.search(ai, human, depth)
+    return _minimax_bits(ai, human, depth, True, -9999, 9999)
 
 
 # ---------- stats ----------
-def get_or_create_stats(user_id: int) -> Dict:
-    with LOCK:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT wins, losses, draws, win_streak, best_streak FROM stats WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.execute(
-                "INSERT OR REPLACE INTO stats (user_id, wins, losses, draws, win_streak, best_streak) VALUES (?,?,?,?,?,?)",
-                (user_id, 0, 0, 0, 0, 0),
-            )
-            conn.commit()
-            stats = {"wins": 0, "losses": 0, "draws": 0, "win_streak": 0, "best_streak": 0}
+STATS_ZERO = {"wins": 0, "losses": 0, "draws": 0, "win_streak": 0, "best_streak": 0}
+SQL_STATS_WIN = (
+    "INSERT INTO stats (user_id, wins, losses, draws, win_streak, best_streak) VALUES (?, 1, 0, 0, 1, 1) "
+    "ON CONFLICT(user_id) DO UPDATE SET wins = wins + 1, win_streak = win_streak + 1, "
+    "best_streak = MAX(best_streak, win_streak + 1)"
+)
+SQL_STATS_LOSS = (
+    "INSERT INTO stats (user_id, wins, losses, draws, win_streak, best_streak) VALUES (?, 0, 1, 0, 0, 0) "
+    "ON CONFLICT(user_id) DO UPDATE SET losses = losses + 1, win_streak = 0"
+)
+SQL_STATS_DRAW = (
+    "INSERT INTO stats (user_id, wins, losses, draws, win_streak, best_streak) VALUES (?, 0, 0, 1, 0, 0) "
+    "ON CONFLICT(user_id) DO UPDATE SET draws = draws + 1, win_streak = 0"
+)
+
+
+def stats_from_row(row: Optional[Tuple]) -> Dict:
+    if not row:
+        return dict(STATS_ZERO)
+    return {"wins": row[0], "losses": row[1], "draws": row[2], "win_streak": row[3], "best_streak": row[4]}
+
+
+def get_stats(user_id: int) -> Dict:
+    WRITES.sync()
+    with DB_POOL.connection() as conn:
+        row = conn.execute(SQL_GET_STATS, (user_id,)).fetchone()
+    return stats_from_row(row)
+
+
+def stats_updates(state: GameState, result: str) -> List[Tuple[str, int]]:
+    updates = []
+    for p in ("X", "O"):
+        uid = state.player(p)
+        if not isinstance(uid, int):
+            continue
+        if result == "draw":
+            updates.append((SQL_STATS_DRAW, uid))
+        elif result == p:
+            updates.append((SQL_STATS_WIN, uid))
         else:
-            stats = {"wins": row[0], "losses": row[1], "draws": row[2], "win_streak": row[3], "best_streak": row[4]}
-        conn.close()
-        return stats
-
-
-def update_stats_on_result(state: Dict, result: str):
-    players = state["players"]
-    if result == "draw":
-        for p in ("X", "O"):
-            uid = players.get(p)
-            if isinstance(uid, int):
-                stats = get_or_create_stats(uid)
-                stats["draws"] += 1
-                stats["win_streak"] = 0
-                with LOCK:
-                    conn = sqlite3.connect(DB_PATH)
-                    cur = conn.cursor()
-                    cur.execute("UPDATE stats SET draws=?, win_streak=? WHERE user_id=?", (stats["draws"], stats["win_streak"], uid))
-                    conn.commit()
-                    conn.close()
-        return
-    
-    winner = result
-    loser = "O" if winner == "X" else "X"
-    winner_id = players.get(winner)
-    loser_id = players.get(loser)
-    
+            updates.append((SQL_STATS_LOSS, uid))
+    return updates
+
+
+def record_results(results: List[Tuple[GameState, str]]) -> Optional[Future]:
+    # نتیجه چند بازی تمام‌شده با هم و در یک گروه اتمی ثبت می‌شود
+    updates = [(sql, (uid,), False) for state, result in results for sql, uid in stats_updates(state, result)]
+    if not updates:
+        return None
+    return WRITES.submit(updates)
+
+
+def update_stats_on_result(state: GameState, result: str) -> Optional[Future]:
+    # آمار تازه برنده در همان گروه خوانده می‌شود؛ Future آن را می‌دهد و کسی منتظر sync جدا نمی‌ماند
+    ops = [(sql, (uid,), False) for sql, uid in stats_updates(state, result)]
+    if not ops:
+        return None
+    winner_id = state.player(result) if result in STATE_PLAYERS else None
     if isinstance(winner_id, int):
-        stats_w = get_or_create_stats(winner_id)
-        stats_w["wins"] += 1
-        stats_w["win_streak"] += 1
-        if stats_w["win_streak"] > stats_w["best_streak"]:
-            stats_w["best_streak"] = stats_w["win_streak"]
-        with LOCK:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE stats SET wins=?, win_streak=?, best_streak=? WHERE user_id=?", (stats_w["wins"], stats_w["win_streak"], stats_w["best_streak"], winner_id))
-            conn.commit()
-            conn.close()
-    
-    if isinstance(loser_id, int):
-        stats_l = get_or_create_stats(loser_id)
-        stats_l["losses"] += 1
-        stats_l["win_streak"] = 0
-        with LOCK:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE stats SET losses=?, win_streak=? WHERE user_id=?", (stats_l["losses"], stats_l["win_streak"], loser_id))
-            conn.commit()
-            conn.close()
+        ops.append((SQL_GET_STATS, (winner_id,), False))
+    return WRITES.submit(ops)
 
 
 def finish_game_and_announce(game_id: str, win_result: str, highlight: Optional[List[int]] = None):
@@ -360,94 +2656,106 @@ def finish_game_and_announce(game_id: str, win_result: str, highlight: Optional[
     if not loaded:
         return
     chat_id, message_id, state, _ = loaded
-    state["finished"] = True
-    state["winner"] = win_result
+    AI_MOVES.cancel(game_id)
+    SPECULATOR.cancel(game_id)
+    state.finished = True
+    state.winner = win_result
     save_game(game_id, chat_id, message_id, state)
-    update_stats_on_result(state, win_result)
-    players = state["players"]
+    stats_done = update_stats_on_result(state, win_result)
+
+    # همه فریم‌ها همین‌جا ساخته می‌شوند؛ نخ مشترک تایمر فقط آن‌ها را می‌فرستد و منتظر دیتابیس یا تلگرام نمی‌ماند
+    frames = []
+    if message_id:
+        plain_frame = partial(_prerendered, render_board(state, highlight=None))
+        for frame in range(4):
+            anim_emoji = WIN_ANIM[frame % len(WIN_ANIM)]
+            header, markup = render_board(state, highlight=highlight, anim_emoji=anim_emoji)
+            win_frame = (f"{header}\n\n🎉 بازیکن {'X' if win_result == 'X' else 'O'} برنده شد! {anim_emoji}", markup)
+            frames.append((partial(_prerendered, win_frame), 0.45))
+            frames.append((plain_frame, 0.25))
+    if win_result == "draw":
+        header, markup = render_board(state)
+        final_text = f"{header}\n\n🤝 بازی مساوی شد!"
+    else:
+        header, markup = render_board(state, highlight=highlight)
+        final_text = f"{header}\n\n🎉 بازیکن {'X' if win_result == 'X' else 'O'} برنده شد! {random.choice(WIN_ANIM)}"
+    cleanup = partial(SHARDS.post, game_id, delete_game, game_id)
+
+    def play(done: Optional[Future]):
+        text = final_text
+        if done is not None and win_result != "draw":
+            try:
+                rows = done.result()[-1]
+                if isinstance(rows, list):
+                    stats = stats_from_row(rows[0] if rows else None)
+                    text += f"\n🏆 رکورد برد فعلی: {stats.get('win_streak',0)} | بهترین رکورد: {stats.get('best_streak',0)}"
+            except Exception as e:
+                print(f"Stats read error: {e}")
+        ANIMATIONS.play(chat_id, message_id, frames, partial(_prerendered, (text, markup)), cleanup)
+
+    # انیمیشن بعد از commit آمار شروع می‌شود تا رکورد برنده بدون صبر روی هیچ نخی در دسترس باشد
+    if stats_done is None:
+        play(None)
+    else:
+        stats_done.add_done_callback(play)
 
-    def anim():
-        try:
-            for frame in range(4):
-                anim_emoji = WIN_ANIM[frame % len(WIN_ANIM)]
-                header, markup = render_board(state, highlight=highlight, anim_emoji=anim_emoji)
-                bot.edit_message_text(
-                    f"{header}\n\n🎉 بازیکن {'X' if win_result == 'X' else 'O'} برنده شد! {anim_emoji}",
-                    chat_id,
-                    message_id,
-                    reply_markup=markup
-                )
-                time.sleep(0.45)
-                
-                header, markup = render_board(state, highlight=None)
-                bot.edit_message_text(header, chat_id, message_id, reply_markup=markup)
-                time.sleep(0.25)
-            
-            if win_result == "draw":
-                header, markup = render_board(state)
-                final_text = f"{header}\n\n🤝 بازی مساوی شد!"
-            else:
-                header, markup = render_board(state, highlight=highlight)
-                winner_id = players.get(win_result)
-                streak_text = ""
-                if isinstance(winner_id, int):
-                    stats = get_or_create_stats(winner_id)
-                    streak_text = f"\n🏆 رکورد برد فعلی: {stats.get('win_streak',0)} | بهترین رکورد: {stats.get('best_streak',0)}"
-                final_text = f"{header}\n\n🎉 بازیکن {'X' if win_result == 'X' else 'O'} برنده شد! {random.choice(WIN_ANIM)}{streak_text}"
-            
-            bot.edit_message_text(final_text, chat_id, message_id, reply_markup=markup)
-        except Exception as e:
-            print(f"Animation error: {e}")
-        finally:
-            delete_game(game_id)
 
-    threading.Thread(target=anim).start()
+def _prerendered(frame: Tuple[str, str]) -> Tuple[str, str]:
+    return frame
 
 
+def load_deadlines():
+    with DB_POOL.connection() as conn:
+        rows = conn.execute(SQL_OPEN_DEADLINES).fetchall()
+    for game_id, deadline in rows:
+        DEADLINES.schedule(game_id, deadline)
+
+
+def expire_game(game_id: str):
+    loaded = load_game(game_id)
+    if not loaded:
+        return
+    chat_id, message_id, st, last_activity = loaded
+    if st.finished:
+        return
+    deadline = last_activity + INACTIVITY_SECONDS
+    if deadline > time.time():
+        DEADLINES.schedule(game_id, deadline)
+        return
+
+    cur_player = st.current_player
+    other = "O" if cur_player == "X" else "X"
+    finish_game_and_announce(game_id, other)
+    OUTBOX.send_message(
+        chat_id,
+        f"⏰ بازی به دلیل عدم فعالیت بیش از {INACTIVITY_SECONDS//60} دقیقه خاتمه یافت.\n"
+        f"بازیکن {other} به دلیل انصراف حریف برنده اعلام شد."
+    )
+
 
 def inactivity_watcher():
+    load_deadlines()
+    next_sweep = 0.0
     while True:
-        with LOCK:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT game_id, chat_id, message_id, state_json, last_activity FROM games")
-            rows = cur.fetchall()
-            conn.close()
-        
-        now = int(time.time())
-        for row in rows:
-            game_id, chat_id, message_id, state_json, last_activity = row
-            st = json.loads(state_json)
-            
-            if st.get("finished"):
-                if now - last_activity > STALE_CLEANUP_SECONDS:
-                    delete_game(game_id)
-                continue
-            
-            if now - last_activity > INACTIVITY_SECONDS:
-                cur_player = st.get("current_player")
-                other = "O" if cur_player == "X" else "X"
-                finish_game_and_announce(game_id, other)
-                try:
-                    bot.send_message(
-                        chat_id,
-                        f"⏰ بازی به دلیل عدم فعالیت بیش از {INACTIVITY_SECONDS//60} دقیقه خاتمه یافت.\n"
-                        f"بازیکن {other} به دلیل انصراف حریف برنده اعلام شد."
-                    )
-                except Exception:
-                    pass
-        
-        time.sleep(30)
-
+        game_id = DEADLINES.next_expired(timeout=STALE_SWEEP_SECONDS)
+        if game_id:
+            SHARDS.post(game_id, expire_game, game_id)
+        if time.time() >= next_sweep:
+            try:
+                GAME_CACHE.delete_stale(int(time.time()) - STALE_CLEANUP_SECONDS)
+            except Exception as e:
+                print(f"Stale cleanup error: {e}")
+            next_sweep = time.time() + STALE_SWEEP_SECONDS
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("forfeit_"))
+@callback_route("forfeit_")
+@game_actor(gid_suffix)
 def handle_forfeit_callback(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 1)[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
             return
         
         chat_id, message_id, state, _ = loaded
@@ -455,7 +2763,7 @@ def handle_forfeit_callback(call: types.CallbackQuery):
         role = who_is_player(state, user.id)
         
         if not role:
-            bot.answer_callback_query(call.id, "شما در این بازی شرکت ندارید.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "شما در این بازی شرکت ندارید.", show_alert=True)
             return
         
         confirm_kb = types.InlineKeyboardMarkup()
@@ -464,26 +2772,27 @@ def handle_forfeit_callback(call: types.CallbackQuery):
             types.InlineKeyboardButton("❌ لغو", callback_data=f"cancel_{gid}")
         )
         
-        bot.edit_message_text(
+        OUTBOX.edit_message_text(
             f"آیا مطمئن هستید که می‌خواهید تسلیم شوید؟",
             chat_id,
             message_id,
             reply_markup=confirm_kb
         )
-        bot.answer_callback_query(call.id)
+        OUTBOX.answer_callback_query(call.id)
         
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در پردازش درخواست.")
-        print(f"Forfeit error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در پردازش درخواست.")
+        handler_error("Forfeit", e)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_forfeit_"))
+@callback_route("confirm_forfeit_")
+@game_actor(gid_suffix)
 def handle_confirm_forfeit(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 2)[2]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
             return
         
         chat_id, message_id, state, _ = loaded
@@ -493,41 +2802,43 @@ def handle_confirm_forfeit(call: types.CallbackQuery):
         if role:
             winner = "O" if role == "X" else "X"
             finish_game_and_announce(gid, winner)
-            bot.answer_callback_query(call.id, "شما با موفقیت تسلیم شدید.")
+            OUTBOX.answer_callback_query(call.id, "شما با موفقیت تسلیم شدید.")
         else:
-            bot.answer_callback_query(call.id, "شما در این بازی شرکت ندارید.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "شما در این بازی شرکت ندارید.", show_alert=True)
             
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در پردازش تسلیم‌شدن.")
-        print(f"Confirm forfeit error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در پردازش تسلیم‌شدن.")
+        handler_error("Confirm forfeit", e)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cancel_"))
+@callback_route("cancel_")
+@game_actor(gid_suffix)
 def handle_cancel(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 1)[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
             return
         
         chat_id, message_id, state, _ = loaded
         header, markup = render_board(state)
-        bot.edit_message_text(header, chat_id, message_id, reply_markup=markup)
-        bot.answer_callback_query(call.id, "عملیات لغو شد.")
+        OUTBOX.edit_message_text(header, chat_id, message_id, reply_markup=markup)
+        OUTBOX.answer_callback_query(call.id, "عملیات لغو شد.")
         
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در لغو عملیات.")
-        print(f"Cancel error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در لغو عملیات.")
+        handler_error("Cancel", e)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("restart_"))
+@callback_route("restart_")
+@game_actor(gid_suffix)
 def handle_restart_callback(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 1)[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
             return
         
         chat_id, message_id, state, _ = loaded
@@ -535,7 +2846,7 @@ def handle_restart_callback(call: types.CallbackQuery):
         role = who_is_player(state, user.id)
         
         if not role:
-            bot.answer_callback_query(call.id, "فقط بازیکنان می‌توانند بازی را ریست‌کنند.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "فقط بازیکنان می‌توانند بازی را ریست‌کنند.", show_alert=True)
             return
         
         confirm_kb = types.InlineKeyboardMarkup()
@@ -544,86 +2855,88 @@ def handle_restart_callback(call: types.CallbackQuery):
             types.InlineKeyboardButton("❌ لغو", callback_data=f"cancel_{gid}")
         )
         
-        bot.edit_message_text(
+        OUTBOX.edit_message_text(
             f"آیا مطمئن هستید که می‌خواهید بازی را ریست‌کنید؟",
             chat_id,
             message_id,
             reply_markup=confirm_kb
         )
-        bot.answer_callback_query(call.id)
+        OUTBOX.answer_callback_query(call.id)
         
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در پردازش درخواست.")
-        print(f"Restart error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در پردازش درخواست.")
+        handler_error("Restart", e)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_restart_"))
+@callback_route("confirm_restart_")
+@game_actor(gid_suffix)
 def handle_confirm_restart(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 2)[2]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی مورد نظر پیدا نشد.", show_alert=True)
             return
         
         chat_id, message_id, state, _ = loaded
-        lock = get_game_lock(gid)
-        with lock:
-            state["board"] = [""] * 9
-            state["current_player"] = "X"
-            state["history"] = []
-            state["finished"] = False
-            state["winner"] = None
-            save_game(gid, chat_id, message_id, state)
-            header, markup = render_board(state)
-            
-            try:
-                if message_id:
-                    bot.edit_message_text("🔄 بازی با موفقیت ریست شد!", chat_id, message_id)
-                    bot.edit_message_text(header, chat_id, message_id, reply_markup=markup)
-                else:
-                    bot.send_message(chat_id, "🔄 بازی ریست شد")
-            except Exception:
-                pass
-            
-        bot.answer_callback_query(call.id, "بازی با موفقیت ریست شد.")
+        AI_MOVES.cancel(gid)
+        SPECULATOR.cancel(gid)
+        state.reset()
+        restart_game(gid, chat_id, message_id, state)
+        if state.game_type == "ai":
+            SPECULATOR.start(gid, state.board, state.ai_difficulty)
+        header, markup = render_board(state)
+        
+        if message_id:
+            OUTBOX.edit_message_text("🔄 بازی با موفقیت ریست شد!", chat_id, message_id)
+            OUTBOX.edit_message_text(header, chat_id, message_id, reply_markup=markup)
+        else:
+            OUTBOX.send_message(chat_id, "🔄 بازی ریست شد")
+        
+        OUTBOX.answer_callback_query(call.id, "بازی با موفقیت ریست شد.")
         
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در ریست‌کردن بازی.")
-        print(f"Confirm restart error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در ریست‌کردن بازی.")
+        handler_error("Confirm restart", e)
 
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("refresh_"))
+@callback_route("refresh_")
+@game_actor(gid_suffix)
 def handle_refresh_callback(call: types.CallbackQuery):
     try:
         gid = call.data.split("_", 1)[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی پیدا نشد یا منقضی شده.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی پیدا نشد یا منقضی شده.", show_alert=True)
             return
         chat_id, message_id, state, _ = loaded
         header, markup = render_board(state)
         
         msginfo = None
         for p in ["X", "O"]:
-            if state.get("messages", {}).get(p, {}).get("chat_id") == call.message.chat.id:
-                msginfo = state["messages"][p]
+            info = state.message(p)
+            if info and info[0] == call.message.chat.id:
+                msginfo = info
                 break
-        try:
-            if msginfo and msginfo.get("message_id"):
-                bot.edit_message_text(header, call.message.chat.id, msginfo["message_id"], reply_markup=markup)
-            else:
-                bot.send_message(call.message.chat.id, header, reply_markup=markup)
-        except Exception:
-            bot.send_message(call.message.chat.id, header, reply_markup=markup)
-        bot.answer_callback_query(call.id, "بورد به‌روز شد.")
+        if msginfo and msginfo[1]:
+            OUTBOX.edit_message_text(
+                header,
+                call.message.chat.id,
+                msginfo[1],
+                reply_markup=markup,
+                on_error=lambda e: OUTBOX.send_message(call.message.chat.id, header, reply_markup=markup),
+            )
+        else:
+            OUTBOX.send_message(call.message.chat.id, header, reply_markup=markup)
+        OUTBOX.answer_callback_query(call.id, "بورد به‌روز شد.")
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در رفرش بورد.")
-        print(f"Refresh error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در رفرش بورد.")
+        handler_error("Refresh", e)
 
 
-@bot.message_handler(commands=["start"])
+@command_route("start")
+@game_actor(gid_of_join)
 def cmd_start(message: types.Message):
     user = message.from_user
     payload = None
@@ -638,55 +2951,62 @@ def cmd_start(message: types.Message):
         loaded = load_game(gid)
         
         if not loaded:
-            bot.send_message(message.chat.id, "⛔ بازی مورد نظر پیدا نشد یا منقضی شده‌است.")
+            OUTBOX.send_message(message.chat.id, "⛔ بازی مورد نظر پیدا نشد یا منقضی شده‌است.")
             return
         
         chat_id, message_id, state, _ = loaded
         
-        if state.get("finished"):
-            bot.send_message(message.chat.id, "⛔ این بازی قبلاً به پایان رسیده‌است.")
+        if state.finished:
+            OUTBOX.send_message(message.chat.id, "⛔ این بازی قبلاً به پایان رسیده‌است.")
             return
         
         if who_is_player(state, user.id):
             header, markup = render_board(state)
-            bot.send_message(message.chat.id, "✅ شما در حال حاضر در این بازی شرکت دارید:", reply_markup=markup)
+            OUTBOX.send_message(message.chat.id, "✅ شما در حال حاضر در این بازی شرکت دارید:", reply_markup=markup)
             return
         
-        if state["game_type"] != "pvp":
-            bot.send_message(message.chat.id, "⛔ این بازی مخصوص دو نفر (PVP) نیست.")
+        if state.game_type != "pvp":
+            OUTBOX.send_message(message.chat.id, "⛔ این بازی مخصوص دو نفر (PVP) نیست.")
             return
         
-        if state["players"].get("O") is None and user.id != state["players"].get("X"):
-            state["players"]["O"] = user.id
+        if state.player_o is None and user.id != state.player_x:
+            state.player_o = user.id
             save_game(gid, chat_id, message_id, state)
             header, markup = render_board(state)
             try:
                 if message_id:
-                    bot.edit_message_text(
+                    OUTBOX.edit_message_text(
                         f"✅ {safe_get_username(user.id)} با موفقیت به بازی پیوست!",
                         chat_id,
                         message_id
                     )
-                    bot.edit_message_text(header, chat_id, message_id, reply_markup=markup)
+                    OUTBOX.edit_message_text(header, chat_id, message_id, reply_markup=markup)
                     # پیام بورد برای بازیکن دوم
-                    msg2 = bot.send_message(message.chat.id, "بورد بازی:", reply_markup=markup)
-                    save_player_message(state, "O", message.chat.id, msg2.message_id, gid)
+                    OUTBOX.send_message(
+                        message.chat.id,
+                        "بورد بازی:",
+                        reply_markup=markup,
+                        on_done=lambda msg2: SHARDS.post(gid, save_player_message, gid, "O", message.chat.id, msg2.message_id),
+                    )
                 else:
-                    msg2 = bot.send_message(chat_id, f"✅ {safe_get_username(user.id)} به بازی پیوست")
-                    save_player_message(state, "O", chat_id, msg2.message_id, gid)
-                bot.send_message(
+                    OUTBOX.send_message(
+                        chat_id,
+                        f"✅ {safe_get_username(user.id)} به بازی پیوست",
+                        on_done=lambda msg2: SHARDS.post(gid, save_player_message, gid, "O", chat_id, msg2.message_id),
+                    )
+                OUTBOX.send_message(
                     message.chat.id,
                     f"✅ شما با موفقیت به بازی پیوستید!\n"
-                    f"🔷 بازیکن X: {safe_get_username(state['players'].get('X'))}\n"
+                    f"🔷 بازیکن X: {safe_get_username(state.player_x)}\n"
                     f"🔶 بازیکن O: شما\n\n"
                     f"لطفا منتظر نوبت خود باشید...",
                     reply_markup=markup
                 )
             except Exception as e:
-                print(f"Join error: {e}")
+                handler_error("Join", e)
             return
         else:
-            bot.send_message(message.chat.id, "⛔ این بازی پر شده‌است یا شما سازنده بازی هستید.")
+            OUTBOX.send_message(message.chat.id, "⛔ این بازی پر شده‌است یا شما سازنده بازی هستید.")
             return
 
     markup = types.InlineKeyboardMarkup()
@@ -699,25 +3019,24 @@ def cmd_start(message: types.Message):
         "به بات بازی دوز خوش آمدید!\n\n"
         "میتوانید با دوستان خود بازی کنید یا مقابل هوش مصنوعی مسابقه دهید."
     )
-    bot.send_message(message.chat.id, text, reply_markup=markup)
+    OUTBOX.send_message(message.chat.id, text, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("menu_"))
+@callback_route("menu_")
 def handle_menu(call: types.CallbackQuery):
     cmd = call.data.split("_", 1)[1]
     
     if cmd == "play":
         markup = types.InlineKeyboardMarkup()
         gid = generate_game_id()
-        state = new_game(game_type="pvp", creator_id=call.from_user.id)
-        state["_id"] = gid
+        state = new_game(game_type="pvp", creator_id=call.from_user.id, game_id=gid)
         save_game(gid, call.message.chat.id, call.message.message_id, state)
         
         markup.add(types.InlineKeyboardButton("👥 بازی دو نفره (PVP)", callback_data=f"mode_pvp|{gid}"))
         markup.add(types.InlineKeyboardButton("🤖 بازی با کامپیوتر (AI)", callback_data=f"mode_ai|{gid}"))
         
-        bot.answer_callback_query(call.id)
-        bot.edit_message_text(
+        OUTBOX.answer_callback_query(call.id)
+        OUTBOX.edit_message_text(
             "لطفا حالت بازی را انتخاب کنید:",
             call.message.chat.id,
             call.message.message_id,
@@ -736,8 +3055,8 @@ def handle_menu(call: types.CallbackQuery):
             "/stats - نمایش آمار بازی\n\n"
             "🎮 برای شروع بازی جدید از منوی اصلی گزینه 'شروع بازی جدید' را انتخاب کنید"
         )
-        bot.answer_callback_query(call.id)
-        bot.edit_message_text(
+        OUTBOX.answer_callback_query(call.id)
+        OUTBOX.edit_message_text(
             help_text,
             call.message.chat.id,
             call.message.message_id
@@ -745,7 +3064,7 @@ def handle_menu(call: types.CallbackQuery):
     
     elif cmd == "stats":
         user_id = call.from_user.id
-        stats = get_or_create_stats(user_id)
+        stats = get_stats(user_id)
         stats_text = (
             f"📊 آمار بازی‌های شما:\n\n"
             f"✅ بردها: {stats['wins']}\n"
@@ -754,14 +3073,15 @@ def handle_menu(call: types.CallbackQuery):
             f"🔥 رکورد برد متوالی: {stats['best_streak']}\n"
             f"🏆 بردهای متوالی فعلی: {stats['win_streak']}"
         )
-        bot.answer_callback_query(call.id)
-        bot.send_message(
+        OUTBOX.answer_callback_query(call.id)
+        OUTBOX.send_message(
             call.message.chat.id,
             stats_text
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("mode_"))
+@callback_route("mode_")
+@game_actor(gid_after_bar)
 def handle_mode(call: types.CallbackQuery):
     try:
         parts = call.data.split("|")
@@ -769,20 +3089,21 @@ def handle_mode(call: types.CallbackQuery):
         gid = parts[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی پیدا نشد یا منقضی شده.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "بازی پیدا نشد یا منقضی شده.", show_alert=True)
             return
         chat_id, message_id, state, _ = loaded
-        state["_id"] = gid
-        state["players"]["X"] = call.from_user.id
+        state.player_x = call.from_user.id
         
         if mode == "pvp":
-            state["game_type"] = "pvp"
+            state.game_type = "pvp"
             save_game(gid, call.message.chat.id, call.message.message_id, state)
             
             try:
-                me = bot.get_me()
+                username = bot_username()
+                if not username:
+                    raise RuntimeError("bot username unavailable")
                 start_payload = f"join_{gid}"
-                link = f"https://t.me/{me.username}?start={start_payload}"
+                link = f"https://t.me/{username}?start={start_payload}"
                 
                 # Improved invite message
                 kb = types.InlineKeyboardMarkup()
@@ -793,41 +3114,42 @@ def handle_mode(call: types.CallbackQuery):
                     f"{link}\n\n"
                     f"این لینک را برای دوست خود ارسال کنید تا به بازی بپیوندد."
                 )
-                bot.send_message(call.message.chat.id, invite_msg, reply_markup=kb)
+                OUTBOX.send_message(call.message.chat.id, invite_msg, reply_markup=kb)
             except Exception as e:
-                print(f"Invite link error: {e}")
-                bot.send_message(call.message.chat.id, "بازی PvP ایجاد شد! لینک دعوت دوست خود را ارسال کنید.")
+                handler_error("Invite link", e)
+                OUTBOX.send_message(call.message.chat.id, "بازی PvP ایجاد شد! لینک دعوت دوست خود را ارسال کنید.")
             
             # Also update the creating message
             header, markup = render_board(state)
-            bot.edit_message_text(
+            OUTBOX.edit_message_text(
                 "بازی دو نفره ایجاد شد! منتظر بازیکن دوم هستیم...",
                 call.message.chat.id,
                 call.message.message_id
             )
-            bot.edit_message_text(
+            OUTBOX.edit_message_text(
                 header,
                 call.message.chat.id,
                 call.message.message_id,
                 reply_markup=markup
             )
-            bot.answer_callback_query(call.id)
+            OUTBOX.answer_callback_query(call.id)
         else:
-            state["game_type"] = "ai"
-            state["players"]["O"] = None
+            state.game_type = "ai"
+            state.player_o = None
             save_game(gid, call.message.chat.id, call.message.message_id, state)
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("🔰 آسان", callback_data=f"diff_easy|{gid}"))
             kb.add(types.InlineKeyboardButton("⚙️ متوسط", callback_data=f"diff_medium|{gid}"))
             kb.add(types.InlineKeyboardButton("🔥 سخت", callback_data=f"diff_hard|{gid}"))
-            bot.edit_message_text("سطح هوش مصنوعی را انتخاب کنید:", call.message.chat.id, call.message.message_id, reply_markup=kb)
-            bot.answer_callback_query(call.id)
+            OUTBOX.edit_message_text("سطح هوش مصنوعی را انتخاب کنید:", call.message.chat.id, call.message.message_id, reply_markup=kb)
+            OUTBOX.answer_callback_query(call.id)
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در انتخاب حالت.")
-        print(f"handle_mode error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در انتخاب حالت.")
+        handler_error("handle_mode", e)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("diff_"))
+@callback_route("diff_")
+@game_actor(gid_after_bar)
 def handle_diff(call: types.CallbackQuery):
     try:
         parts = call.data.split("|")
@@ -835,44 +3157,45 @@ def handle_diff(call: types.CallbackQuery):
         gid = parts[1]
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "بازی پیدا نشد.")
+            OUTBOX.answer_callback_query(call.id, "بازی پیدا نشد.")
             return
         chat_id, message_id, state, _ = loaded
-        state["_id"] = gid
-        state["ai_difficulty"] = diff
-        state["players"]["O"] = "AI"
+        state.ai_difficulty = diff
+        state.player_o = "AI"
         save_game(gid, call.message.chat.id, call.message.message_id, state)
         header, kb = render_board(state)
+        OUTBOX.edit_message_text(
+            header,
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=kb,
+            on_error=lambda e: OUTBOX.send_message(call.message.chat.id, header, reply_markup=kb),
+        )
         
-        try:
-            msg = bot.edit_message_text(header, call.message.chat.id, call.message.message_id, reply_markup=kb)
-            save_game(gid, call.message.chat.id, msg.message_id, state)
-        except Exception:
-            bot.send_message(call.message.chat.id, header, reply_markup=kb)
-        
-        
-        if state["game_type"] == "ai" and state["current_player"] == "O":
-            threading.Thread(target=do_ai_move, args=(gid,)).start()
+        if state.game_type == "ai" and state.current_player == "O":
+            AI_MOVES.submit(gid)
+        elif state.game_type == "ai":
+            SPECULATOR.start(gid, state.board, diff)
         
-        bot.answer_callback_query(call.id, f"سطح AI: {diff}")
+        OUTBOX.answer_callback_query(call.id, f"سطح AI: {diff}")
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در انتخاب سختی.")
-        print(f"handle_diff error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در انتخاب سختی.")
+        handler_error("handle_diff", e)
 
 
-@bot.message_handler(commands=["play"])
+@command_route("play")
 def cmd_play(message: types.Message):
     gid = generate_game_id()
-    state = new_game("pvp", message.from_user.id)
-    state["_id"] = gid
+    state = new_game("pvp", message.from_user.id, game_id=gid)
     save_game(gid, message.chat.id, None, state)
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("👥 بازی دو نفره (PVP)", callback_data=f"mode_pvp|{gid}"))
     kb.add(types.InlineKeyboardButton("🤖 بازی با کامپیوتر (AI)", callback_data=f"mode_ai|{gid}"))
-    bot.send_message(message.chat.id, "لطفا حالت بازی را انتخاب کنید:", reply_markup=kb)
+    OUTBOX.send_message(message.chat.id, "لطفا حالت بازی را انتخاب کنید:", reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("move_"))
+@callback_route("move_")
+@game_actor(gid_of_move)
 def handle_move(call: types.CallbackQuery):
     try:
         payload = call.data.split("_", 1)[1]
@@ -880,172 +3203,250 @@ def handle_move(call: types.CallbackQuery):
         pos = int(pos)
         loaded = load_game(gid)
         if not loaded:
-            bot.answer_callback_query(call.id, "این بازی پیدا نشد یا منقضی شده.", show_alert=True)
+            OUTBOX.answer_callback_query(call.id, "این بازی پیدا نشد یا منقضی شده.", show_alert=True)
             return
         chat_id, message_id, state, _ = loaded
-        state["_id"] = gid
-        if state.get("finished"):
-            bot.answer_callback_query(call.id, "بازی قبلاً تمام شده.", show_alert=True)
+        if state.finished:
+            OUTBOX.answer_callback_query(call.id, "بازی قبلاً تمام شده.", show_alert=True)
             return
 
-        lock = get_game_lock(gid)
-        acquired = lock.acquire(blocking=False)
-        if not acquired:
-            bot.answer_callback_query(call.id, "در حال پردازش حرکت قبلی...", show_alert=False)
-            return
-
-        try:
-            user = call.from_user
-            player = who_is_player(state, user.id)
-            
-            if not player:
-                if state["game_type"] == "pvp" and state["players"].get("O") is None and user.id != state["players"].get("X"):
-                    state["players"]["O"] = user.id
-                    player = "O"
-                    save_game(gid, chat_id, message_id, state)
-                    
-                    try:
-                        header, kb = render_board(state)
-                        if message_id:
-                            bot.edit_message_text(f"✅ {user.first_name} به بازی پیوست!", chat_id, message_id)
-                            bot.edit_message_text(header, chat_id, message_id, reply_markup=kb)
-                    except Exception:
-                        pass
-                else:
-                    bot.answer_callback_query(call.id, "شما در این بازی نیستید یا بازی پر است.", show_alert=True)
-                    return
-
-            if player != state["current_player"]:
-                bot.answer_callback_query(call.id, "الان نوبت شما نیست.", show_alert=True)
+        user = call.from_user
+        player = who_is_player(state, user.id)
+        
+        if not player:
+            if state.game_type == "pvp" and state.player_o is None and user.id != state.player_x:
+                state.player_o = user.id
+                player = "O"
+                save_game(gid, chat_id, message_id, state)
+                
+                try:
+                    header, kb = render_board(state)
+                    if message_id:
+                        OUTBOX.edit_message_text(f"✅ {user.first_name} به بازی پیوست!", chat_id, message_id)
+                        OUTBOX.edit_message_text(header, chat_id, message_id, reply_markup=kb)
+                except Exception:
+                    pass
+            else:
+                OUTBOX.answer_callback_query(call.id, "شما در این بازی نیستید یا بازی پر است.", show_alert=True)
                 return
 
-            if state["board"][pos] != "":
-                bot.answer_callback_query(call.id, "این خانه قبلاً انتخاب شده.", show_alert=True)
-                return
+        if player != state.current_player:
+            OUTBOX.answer_callback_query(call.id, "الان نوبت شما نیست.", show_alert=True)
+            return
 
-            state["board"][pos] = player
-            state["history"].append({"player": player, "pos": pos, "time": int(time.time())})
-            update_last_activity(gid)
-            save_game(gid, chat_id, message_id, state)
+        if state.board[pos] != "":
+            OUTBOX.answer_callback_query(call.id, "این خانه قبلاً انتخاب شده.", show_alert=True)
+            return
 
-            winner_line = check_winner(state["board"])
-            if winner_line:
-                win_player, line = winner_line
-                finish_game_and_announce(gid, win_player, highlight=line)
-                bot.answer_callback_query(call.id, "بازی تمام شد.")
-                return
+        state.play(pos, player, int(time.time()))
+        winner_line = check_winner(state.board)
+        draw = not winner_line and is_draw(state.board)
+        if not winner_line and not draw:
+            state.current_player = "O" if state.current_player == "X" else "X"
+        record_move(gid, chat_id, message_id, state)
 
-            if is_draw(state["board"]):
-                finish_game_and_announce(gid, "draw")
-                bot.answer_callback_query(call.id, "مساوی شد.")
-                return
+        if winner_line:
+            win_player, line = winner_line
+            finish_game_and_announce(gid, win_player, highlight=line)
+            OUTBOX.answer_callback_query(call.id, "بازی تمام شد.")
+            return
 
-            state["current_player"] = "O" if state["current_player"] == "X" else "X"
-            save_game(gid, chat_id, message_id, state)
-            header, kb = render_board(state)
-            try:
-               
-                for p in ["X", "O"]:
-                    user_id = state["players"].get(p)
-                    if not user_id:
-                        continue
-                    msginfo = state.get("messages", {}).get(p)
-                    updated = False
-                    if msginfo and msginfo.get("chat_id") and msginfo.get("message_id"):
-                        try:
-                            bot.edit_message_text(header + "\n\n⏳ حرکت ثبت شد.", msginfo["chat_id"], msginfo["message_id"], reply_markup=kb)
-                            updated = True
-                        except Exception:
-                            pass
-                    if not updated:
-                        
-                        try:
-                            msg = bot.send_message(user_id, header + "\n\n⏳ حرکت ثبت شد.", reply_markup=kb)
-                            if "messages" not in state:
-                                state["messages"] = {}
-                            state["messages"][p] = {"chat_id": user_id, "message_id": msg.message_id}
-                            save_game(gid, chat_id, message_id, state)
-                        except Exception:
-                            pass
-                
-                if message_id:
-                    bot.edit_message_text(header + "\n\n⏳ حرکت ثبت شد.", chat_id, message_id, reply_markup=kb)
-                else:
-                    bot.send_message(chat_id, header)
-            except Exception:
-                pass
-            
-            bot.answer_callback_query(call.id, "حرکت ثبت شد.")
+        if draw:
+            finish_game_and_announce(gid, "draw")
+            OUTBOX.answer_callback_query(call.id, "مساوی شد.")
+            return
 
-            if state["game_type"] == "ai" and state["players"].get("O") == "AI" and state["current_player"] == "O":
-                threading.Thread(target=do_ai_move, args=(gid,)).start()
+        header, kb = render_board(state)
+        fan_out_board(gid, state, chat_id, message_id, header + "\n\n⏳ حرکت ثبت شد.", kb)
+        
+        OUTBOX.answer_callback_query(call.id, "حرکت ثبت شد.")
 
-        finally:
-            lock.release()
+        if state.game_type == "ai" and state.player_o == "AI" and state.current_player == "O":
+            SPECULATOR.stop(gid)
+            AI_MOVES.submit(gid)
 
     except Exception as e:
-        bot.answer_callback_query(call.id, "خطا در پردازش حرکت.")
-        print(f"handle_move error: {e}")
+        OUTBOX.answer_callback_query(call.id, "خطا در پردازش حرکت.")
+        handler_error("handle_move", e)
 
 
 def do_ai_move(gid: str):
-    time.sleep(1)
+    # حرکت روی نخ AI حساب می‌شود و فقط خواندن و اعمالش روی شارد بازی است
+    turn = SHARDS.run(gid, ai_turn, gid)
+    if turn is None:
+        return
+    board, difficulty = turn
+    move = SPECULATOR.take(gid, board)
+    if move is None:
+        move = ai_choose_move(board, difficulty)
+    if move is None:
+        return
+    SHARDS.run(gid, apply_ai_move, gid, board, move)
+
+
+def ai_turn(gid: str) -> Optional[Tuple[Bitboard, Optional[str]]]:
+    loaded = load_game(gid)
+    if not loaded:
+        return None
+    state = loaded[2]
+    if state.finished or state.current_player != "O":
+        return None
+    return Bitboard(state.board.x, state.board.o), state.ai_difficulty
+
+
+def apply_ai_move(gid: str, board: Bitboard, move: int):
     loaded = load_game(gid)
     if not loaded:
         return
     chat_id, message_id, state, _ = loaded
-    if state.get("finished"):
+    if state.finished or state.current_player != "O" or state.board != board:
+        return  # بازی در این فاصله ریست یا تمام شده
+    
+    state.play(move, "O", int(time.time()))
+    winner_line = check_winner(state.board)
+    draw = not winner_line and is_draw(state.board)
+    if not winner_line and not draw:
+        state.current_player = "X"
+    record_move(gid, chat_id, message_id, state)
+
+    if winner_line:
+        win_player, line = winner_line
+        finish_game_and_announce(gid, win_player, highlight=line)
+        return
+    
+    if draw:
+        finish_game_and_announce(gid, "draw")
         return
-    lock = get_game_lock(gid)
-    with lock:
-        move = ai_choose_move(state)
-        if move is None:
-            return
-        
-        state["board"][move] = "O"
-        state["history"].append({"player": "O", "pos": move, "time": int(time.time())})
-        update_last_activity(gid)
-        save_game(gid, chat_id, message_id, state)
-
-        winner_line = check_winner(state["board"])
-        if winner_line:
-            win_player, line = winner_line
-            finish_game_and_announce(gid, win_player, highlight=line)
-            return
-        
-        if is_draw(state["board"]):
-            finish_game_and_announce(gid, "draw")
-            return
 
-        state["current_player"] = "X"
-        save_game(gid, chat_id, message_id, state)
-        header, kb = render_board(state)
-        try:
-            if message_id:
-                bot.edit_message_text(header, chat_id, message_id, reply_markup=kb)
-            else:
-                bot.send_message(chat_id, header)
-        except Exception:
-            pass
+    SPECULATOR.start(gid, state.board, state.ai_difficulty)
+    header, kb = render_board(state)
+    fan_out_board(gid, state, chat_id, message_id, header, kb)
 
 
 
-def save_player_message(state, player, chat_id, message_id, gid):
-    if "messages" not in state:
-        state["messages"] = {}
-    state["messages"][player] = {"chat_id": chat_id, "message_id": message_id}
-    
+def save_player_message(gid: str, player: str, chat_id: int, message_id: int):
+    # روی شارد بازی و با وضعیت همین لحظه؛ فقط نشانی پیام‌ها عوض می‌شود، نه حرکت‌ها و زمان فعالیت
+    loaded = load_game(gid)
+    if not loaded:
+        return
+    state = loaded[2]
+    state.set_message(player, chat_id, message_id)
     if player == "X":
-        save_game(gid, chat_id, message_id, state)
+        GAME_CACHE.relink(gid, chat_id, message_id)
     else:
-        
-        save_game(gid, state["messages"].get("X", {}).get("chat_id", chat_id), state["messages"].get("X", {}).get("message_id", message_id), state)
+        GAME_CACHE.relink(gid, *(state.message_x or (chat_id, message_id)))
+
+
+# ---------- metrics endpoint ----------
+METRICS.gauge("nvs_live_games", "Games held in the write-back cache", lambda: len(GAME_CACHE))
+METRICS.gauge("nvs_open_deadlines", "Unfinished games with a scheduled inactivity deadline", lambda: len(DEADLINES))
+METRICS.gauge("nvs_animations_active", "Win animations currently playing", lambda: ANIMATIONS.active)
+METRICS.gauge("nvs_animation_frames_skipped_total", "Animation frames dropped under outbox backlog", lambda: ANIMATIONS.skipped, "counter")
+METRICS.gauge("nvs_timers_pending", "Callbacks waiting on the shared timer thread", lambda: len(TIMERS))
+METRICS.gauge("nvs_ai_waiting", "AI replies in their think delay", lambda: AI_MOVES.waiting)
+METRICS.gauge("nvs_ai_queued", "AI replies waiting for a search worker", lambda: AI_MOVES.queued)
+METRICS.gauge("nvs_ai_running", "AI searches running", lambda: AI_MOVES.running)
+METRICS.gauge("nvs_shard_queue_depth", "Tasks queued on game shards", lambda: SHARDS.depth())
+METRICS.gauge("nvs_outbox_pending", "Outbound messages not yet sent", lambda: OUTBOX.pending())
+METRICS.gauge("nvs_outbox_sent_total", "Outbound messages delivered", lambda: OUTBOX.sent, "counter")
+METRICS.gauge("nvs_outbox_coalesced_total", "Board edits merged into a queued edit", lambda: OUTBOX.coalesced, "counter")
+METRICS.gauge("nvs_outbox_unchanged_total", "Edits skipped because the message already shows that content", lambda: OUTBOX.unchanged, "counter")
+METRICS.gauge("nvs_outbox_failed_total", "Outbound messages given up on", lambda: OUTBOX.failed, "counter")
+METRICS.gauge("nvs_db_commits_total", "Group-commit transactions", lambda: WRITES.batches, "counter")
+METRICS.gauge("nvs_db_writes_total", "Statements written through group commit", lambda: WRITES.writes, "counter")
+METRICS.gauge("nvs_db_commit_failures_total", "Write groups that failed to commit", lambda: WRITES.failed, "counter")
+METRICS.gauge("nvs_render_cache_hits_total", "Board renders served from cache", lambda: RENDERS.hits, "counter")
+METRICS.gauge("nvs_render_cache_misses_total", "Board renders built", lambda: RENDERS.misses, "counter")
+METRICS.gauge("nvs_threads", "Live Python threads", threading.active_count)
+
+
+class MetricsServer:
+    # endpoint محلی متن Prometheus؛ هر scrape فقط یک کپی کوتاه زیر قفل رجیستری است
+    def __init__(self, registry: MetricsRegistry, host: str, port: int, path: str = METRICS_PATH):
+        self.registry = registry
+        self.path = path
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != server.path:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
 
+        return Handler
 
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+METRICS_SERVER: Optional[MetricsServer] = None
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[MetricsServer]:
+    global METRICS_SERVER
+    if METRICS_SERVER is not None or not port:
+        return METRICS_SERVER
+    try:
+        METRICS_SERVER = MetricsServer(METRICS, host, port)
+    except Exception as e:
+        print(f"Metrics server error: {e}")
+        return None
+    METRICS_SERVER.start()
+    return METRICS_SERVER
+
+
+# ---------- runtime ----------
+def use_runtime(api=None, timers=None):
+    global API
+    if api is not None:
+        API = CountingApi(api)
+        OUTBOX.api = API
+    if timers is not None:
+        ANIMATIONS.timers = timers
+        AI_MOVES.timers = timers
+
+
+def start_runtime(timers: bool = True, flusher: bool = True):
+    init_db()
+    WRITES.start()
+    if AI_PROCESS_POOL:
+        SEARCH_POOL.start()
+    PERFECT_PLAY.build()
+    OUTBOX.start()
+    SHARDS.start()
+    start_metrics_server()
+    if timers:
+        TIMERS.start()
+    threading.Thread(target=inactivity_watcher, daemon=True).start()
+    if flusher:
+        threading.Thread(target=game_flusher, daemon=True).start()
 
-init_db()
-threading.Thread(target=inactivity_watcher, daemon=True).start()
 
 if __name__ == "__main__":
+    start_runtime()
+    load_bot_username()
     print("Bot started with improved UI/UX and fixed bugs...")
     bot.infinity_polling(timeout=60, long_polling_timeout=60)
\ No newline at end of file
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telebot import apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import nvs_TicTacToeBOT as core
+
+
+# منطق بازی همان هسته همگام است؛ این فایل فقط ورودی و خروجی را روی asyncio می‌برد
+ASYNC_CORE_WORKERS = 32
+ASYNC_API_TIMEOUT = 30
+
+
+class AsyncApiBridge:
+    # هسته از نخ‌های executor همان متدهای TeleBot را صدا می‌زند و این‌جا روی حلقه AsyncTeleBot اجرا می‌شوند
+    def __init__(self, abot: AsyncTeleBot, loop: asyncio.AbstractEventLoop, timeout: float):
+        self.abot = abot
+        self.loop = loop
+        self.timeout = timeout
+
+    def _call(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(self.timeout)
+        except asyncio_helper.ApiTelegramException as e:
+            # Outbox خطای نسخه همگام را می‌شناسد (429، message is not modified)
+            raise apihelper.ApiTelegramException(e.function_name, e.result, e.result_json) from e
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call(self.abot.send_message(chat_id, text, **kwargs))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self._call(self.abot.edit_message_text(text, chat_id, message_id, **kwargs))
+
+    def answer_callback_query(self, callback_query_id, text=None, show_alert=None, **kwargs):
+        return self._call(self.abot.answer_callback_query(callback_query_id, text, show_alert, **kwargs))
+
+    def get_chat(self, chat_id):
+        return self._call(self.abot.get_chat(chat_id))
+
+    def get_me(self):
+        return self._call(self.abot.get_me())
+
+
+class LoopTimers:
+    # جایگزین TimerScheduler: زمان‌بندی با call_later حلقه، اجرای کار در executor
+    def __init__(self, loop: asyncio.AbstractEventLoop, executor: ThreadPoolExecutor):
+        self.loop = loop
+        self.executor = executor
+
+    def call_later(self, delay: float, fn, *args) -> core.TimerHandle:
+        handle = core.TimerHandle(time.monotonic() + delay, fn, args)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._fire, handle)
+        return handle
+
+    def _fire(self, handle: core.TimerHandle):
+        if not handle.cancelled:
+            self.loop.run_in_executor(self.executor, self._run, handle)
+
+    @staticmethod
+    def _run(handle: core.TimerHandle):
+        if handle.cancelled:
+            return
+        try:
+            handle.fn(*handle.args)
+        except Exception as e:
+            print(f"timers task error: {e}")
+
+
+def register_routes(abot: AsyncTeleBot, executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+
+    def bind(handler):
+        async def on_update(update):
+            core.PROFILES.remember(update.from_user)
+            await loop.run_in_executor(executor, handler, update)
+        return on_update
+
+    for prefix, handler in core.CALLBACK_ROUTES:
+        abot.register_callback_query_handler(bind(handler), func=lambda call, prefix=prefix: call.data.startswith(prefix))
+    for command, handler in core.COMMAND_ROUTES:
+        abot.register_message_handler(bind(handler), commands=[command])
+
+
+async def flush_games_periodically(executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(core.GAME_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(executor, partial(core.GAME_CACHE.flush, evict=True))
+        except Exception as e:
+            print(f"Game flush error: {e}")
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=ASYNC_CORE_WORKERS, thread_name_prefix="core")
+    loop.set_default_executor(executor)
+    abot = AsyncTeleBot(core.BOT_TOKEN)
+    core.use_runtime(api=AsyncApiBridge(abot, loop, ASYNC_API_TIMEOUT), timers=LoopTimers(loop, executor))
+    await loop.run_in_executor(executor, partial(core.start_runtime, timers=False, flusher=False))
+    register_routes(abot, executor)
+    flusher = asyncio.create_task(flush_games_periodically(executor))
+    await loop.run_in_executor(executor, core.load_bot_username)
+    print("Async bot started...")
+    try:
+        await abot.infinity_polling(timeout=60, request_timeout=90)
+    finally:
+        flusher.cancel()
+        await loop.run_in_executor(executor, core.flush_games)
+        await abot.close_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+import hmac
+import json
+import os
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Tuple
+
+from telebot import types
+
+import nvs_TicTacToeBOT as core
+
+
+# ورودی با وبهوک: سرور HTTP فقط آپدیت را صف می‌کند و سریع 200 برمی‌گرداند، کارگرها پردازش می‌کنند
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # آدرس عمومی که به تلگرام داده می‌شود، مثلا https://example.com/telegram
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 8
+WEBHOOK_MAX_BODY = 1 << 20
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def process_update(update: types.Update):
+    core.bot.process_new_updates([update])
+
+
+class WebhookServer:
+    def __init__(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret: str = WEBHOOK_SECRET, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS, process: Callable[[types.Update], None] = process_update):
+        if not secret and host not in LOOPBACK_HOSTS:
+            # بدون توکن مخفی هر کس به پورت برسد می‌تواند آپدیت جعلی از طرف هر کاربری بفرستد
+            print(f"Webhook: WEBHOOK_SECRET is empty, listening on 127.0.0.1 instead of {host}")
+            host = "127.0.0.1"
+        self.path = path
+        self.secret = secret.encode()
+        self.process = process
+        self.workers = workers
+        self.updates: "queue.Queue[Optional[types.Update]]" = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0  # توکن یا مسیر یا بدنه نامعتبر
+        self.dropped = 0  # صف پر بود؛ تلگرام دوباره می‌فرستد
+        self.failed = 0
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive: تلگرام اتصال‌ها را دوباره استفاده می‌کند
+
+            def do_POST(self):
+                # بدنه همیشه قبل از جواب خوانده می‌شود؛ وگرنه روی اتصال keep-alive درخواست بعدی خراب می‌شود
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > WEBHOOK_MAX_BODY:
+                    server._count("rejected")
+                    self.close_connection = True
+                    self._reply(400)
+                    return
+                self._reply(server.accept(self.path, self.headers, self.rfile.read(length)))
+
+            def do_GET(self):
+                self._reply(405)
+
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                if self.close_connection:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def accept(self, path: str, headers, raw: bytes) -> int:
+        if path != self.path:
+            self._count("rejected")
+            return 404
+        token = (headers.get(SECRET_HEADER) or "").encode()
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            self._count("rejected")
+            return 403
+        if not raw:
+            self._count("rejected")
+            return 400
+        try:
+            update = types.Update.de_json(json.loads(raw))
+        except Exception as e:
+            print(f"Webhook parse error: {e}")
+            self._count("rejected")
+            return 400
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            self._count("dropped")
+            return 503
+        self._count("received")
+        return 200
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.process(update)
+                self._count("processed")
+            except Exception as e:
+                self._count("failed")
+                print(f"Webhook update error: {e}")
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f"webhook-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+
+    def stop(self, timeout: float = 5.0):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in self._threads:
+            self.updates.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+def main():
+    # هندلرها روی کارگرهای همین صف اجرا شوند، نه صف بی‌سقف داخلی TeleBot
+    core.bot.threaded = False
+    core.start_runtime()
+    core.bot_username()
+    server = WebhookServer()
+    server.start()
+    if WEBHOOK_URL:
+        core.bot.remove_webhook()
+        core.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                             max_connections=WEBHOOK_MAX_CONNECTIONS)
+    host, port = server.address
+    print(f"Webhook bot listening on {host}:{port}{WEBHOOK_PATH}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        core.flush_games()
+
+
+if __name__ == "__main__":
+    main()
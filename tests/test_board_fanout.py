@@ -0,0 +1,201 @@
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import apihelper, types
+
+import nvs_TicTacToeBOT as core
+
+
+PLAYER_X = 20_000_001
+PLAYER_O = 20_000_002
+
+
+class RecordingApi:
+    # به‌جای تلگرام: پیام‌های هر چت در حافظه، و ویرایش پیام پاک‌شده مثل تلگرام خطای 400 می‌دهد
+    def __init__(self):
+        self.sent = {}
+        self.content = {}
+        self.deleted = set()
+        self._ids = itertools.count(1000)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _markup(reply_markup):
+        if reply_markup is None or isinstance(reply_markup, str):
+            return reply_markup
+        return reply_markup.to_json()
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        with self._lock:
+            message_id = next(self._ids)
+            self.sent.setdefault(chat_id, []).append(message_id)
+            self.content[(chat_id, message_id)] = (text, self._markup(reply_markup))
+        return SimpleNamespace(message_id=message_id, chat=SimpleNamespace(id=chat_id))
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None, **kwargs):
+        with self._lock:
+            if (chat_id, message_id) in self.deleted:
+                raise apihelper.ApiTelegramException(
+                    "editMessageText", None, {"error_code": 400, "description": "Bad Request: message to edit not found"})
+            self.content[(chat_id, message_id)] = (text, self._markup(reply_markup))
+        return True
+
+    def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    def get_me(self):
+        return SimpleNamespace(username="test_bot")
+
+    def get_chat(self, chat_id):
+        return SimpleNamespace(id=chat_id, first_name=f"p{chat_id}", username=None)
+
+    def boards(self, chat_id):
+        # پیام‌هایی از این چت که الان بورد بازی را نشان می‌دهند
+        with self._lock:
+            return [m for m in self.sent.get(chat_id, []) if "move_" in (self.content[(chat_id, m)][1] or "")]
+
+    def cells(self, chat_id, message_id):
+        markup = self.content[(chat_id, message_id)][1]
+        rows = json.loads(markup)["inline_keyboard"][:3]
+        return ["X" if b["text"] == core.EMOJI_X else "O" if b["text"] == core.EMOJI_O else "" for row in rows for b in row]
+
+
+class Flow:
+    def __init__(self, api):
+        self.api = api
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"p{user_id}"}
+
+    def _dispatch(self, update):
+        update["update_id"] = next(self._ids)
+        core.bot.process_new_updates([types.Update.de_json(update)])
+
+    def command(self, user_id, text):
+        command = text.split()[0]
+        self._dispatch({"message": {
+            "message_id": next(self._ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id), "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}})
+
+    def click(self, user_id, message_id, data):
+        self._dispatch({"callback_query": {
+            "id": str(next(self._ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "text": "board"}}})
+
+    def drain(self, gid):
+        # کار شارد، صف خروجی و callbackهایی که دوباره روی شارد می‌نشینند تا آرام شدن کامل
+        for _ in range(4):
+            core.SHARDS.submit(gid, lambda: None).result(5)
+            assert core.OUTBOX.wait_idle(5)
+
+    def start_pvp_via_deeplink(self):
+        self.command(PLAYER_X, "/play")
+        assert core.OUTBOX.wait_idle(5)
+        menu = self.api.sent[PLAYER_X][-1]
+        gid = re.search(r"mode_pvp\|(\w+)", self.api.content[(PLAYER_X, menu)][1]).group(1)
+        self.click(PLAYER_X, menu, f"mode_pvp|{gid}")
+        self.drain(gid)
+        self.command(PLAYER_O, f"/start join_{gid}")
+        self.drain(gid)
+        return gid, menu
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    api = RecordingApi()
+    core.DB_POOL.path = str(tmp_path_factory.mktemp("db") / "test.db")
+    core.init_db()
+    core.bot.threaded = False
+    core.use_runtime(api=api)
+    # سقف هر چت برای تلگرام است؛ اینجا فقط کند می‌کند
+    core.OUTBOX.chat_rate = core.OUTBOX.chat_burst = 1000
+    core.OUTBOX.start()
+    core.SHARDS.start()
+    core.TIMERS.start()
+    yield api
+    core.flush_games()
+    core.DB_POOL.close_all()
+
+
+def test_creator_board_follows_moves_after_deeplink_join(api):
+    flow = Flow(api)
+    gid, menu = flow.start_pvp_via_deeplink()
+    state = core.load_game(gid)[2]
+    assert state.player_o == PLAYER_O
+
+    flow.click(PLAYER_X, menu, f"move_{gid}|0")
+    flow.drain(gid)
+    flow.click(PLAYER_O, api.boards(PLAYER_O)[-1], f"move_{gid}|4")
+    flow.drain(gid)
+
+    expected = ["X", "", "", "", "O", "", "", "", ""]
+    x_boards = [m for m in api.boards(PLAYER_X) if api.cells(PLAYER_X, m) == expected]
+    o_boards = [m for m in api.boards(PLAYER_O) if api.cells(PLAYER_O, m) == expected]
+    assert x_boards, "X never saw O's reply"
+    assert o_boards
+    # بورد X باید در چت خود X بماند، نه روی پیام O
+    chat_x, message_x = core.load_game(gid)[2].message_x
+    assert chat_x == PLAYER_X and message_x in api.sent[PLAYER_X]
+
+
+def test_deleted_board_is_recovered_once_in_its_own_chat(api):
+    flow = Flow(api)
+    gid, menu = flow.start_pvp_via_deeplink()
+    flow.click(PLAYER_X, menu, f"move_{gid}|0")
+    flow.drain(gid)
+
+    o_board = core.load_game(gid)[2].message_o
+    api.deleted.add(o_board)
+    o_sent = len(api.sent[PLAYER_O])
+    x_sent = len(api.sent[PLAYER_X])
+
+    for player, pos in ((PLAYER_O, 4), (PLAYER_X, 1), (PLAYER_O, 7)):
+        flow.click(player, menu, f"move_{gid}|{pos}")
+        flow.drain(gid)
+
+    # یک بورد تازه برای O، هیچ بورد تازه‌ای برای X و هیچ بوردی از X در چت O
+    assert len(api.sent[PLAYER_O]) - o_sent == 1
+    assert len(api.sent[PLAYER_X]) == x_sent
+    state = core.load_game(gid)[2]
+    assert state.message_o == (PLAYER_O, api.sent[PLAYER_O][-1])
+    assert state.message_x[0] == PLAYER_X
+    assert api.cells(PLAYER_O, api.sent[PLAYER_O][-1]) == ["X", "X", "", "", "O", "", "", "O", ""]
+
+
+def test_win_announcement_carries_the_winners_streak(api):
+    flow = Flow(api)
+    gid, menu = flow.start_pvp_via_deeplink()
+    primary = core.load_game(gid)[:2]
+    for player, pos in ((PLAYER_X, 0), (PLAYER_O, 3), (PLAYER_X, 1), (PLAYER_O, 4), (PLAYER_X, 2)):
+        flow.click(player, menu, f"move_{gid}|{pos}")
+        flow.drain(gid)
+    # فریم نهایی بعد از انیمیشن روی تایمر مشترک؛ آمار از همان گروه نوشتن می‌آید
+    end = time.monotonic() + 10
+    while core.ANIMATIONS.active and time.monotonic() < end:
+        time.sleep(0.05)
+    assert core.OUTBOX.wait_idle(5)
+    text = api.content[primary][0]
+    assert "برنده شد" in text
+    assert "رکورد برد فعلی: " in text
+    assert core.get_stats(PLAYER_X)["wins"] >= 1
+
+
+def test_markup_without_bot_username_is_rebuilt_once_it_arrives(monkeypatch):
+    state = core.new_game("pvp", PLAYER_X, None, game_id="render000001")
+    monkeypatch.setattr(core, "bot_username", lambda: None)
+    assert "start=join_" not in core.render_board(state)[1]
+    monkeypatch.setattr(core, "bot_username", lambda: "test_bot")
+    assert "https://t.me/test_bot?start=join_render000001" in core.render_board(state)[1]
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nvs_TicTacToeBOT as core
+
+
+@pytest.fixture
+def writes(tmp_path):
+    pool = core.ConnectionPool(str(tmp_path / "writes.db"))
+    with pool.connection() as conn, conn:
+        conn.execute("CREATE TABLE t (k INTEGER PRIMARY KEY, v TEXT)")
+    # پنجره بلند تا هر دو گروه در یک دسته بنشینند
+    committer = core.GroupCommitter(pool, 0.2, 256)
+    committer.start()
+    yield committer, pool
+    committer.stop()
+    pool.close_all()
+
+
+def rows(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT k, v FROM t ORDER BY k").fetchall()
+
+
+def test_groups_share_one_transaction(writes):
+    committer, pool = writes
+    futures = [committer.execute("INSERT INTO t (k, v) VALUES (?, ?)", (i, f"v{i}")) for i in range(20)]
+    assert [f.result(5) for f in futures] == [[1]] * 20
+    assert committer.batches == 1 and committer.writes == 20
+    assert len(rows(pool)) == 20
+
+
+def test_failed_group_is_retried_alone(writes):
+    committer, pool = writes
+    good = committer.submit([("INSERT INTO t (k, v) VALUES (?, ?)", (1, "a"), False),
+                             ("INSERT INTO t (k, v) VALUES (?, ?)", (2, "b"), False)])
+    # کلید تکراری داخل خود گروه: کل گروه باید برگردد، نه فقط دستور دوم
+    bad = committer.submit([("INSERT INTO t (k, v) VALUES (?, ?)", (3, "c"), False),
+                            ("INSERT INTO t (k, v) VALUES (?, ?)", (3, "d"), False)])
+    after = committer.execute("INSERT INTO t (k, v) VALUES (?, ?)", (4, "e"))
+    assert good.result(5) == [1, 1]
+    assert after.result(5) == [1]
+    with pytest.raises(sqlite3.IntegrityError):
+        bad.result(5)
+    assert committer.failed == 1
+    assert rows(pool) == [(1, "a"), (2, "b"), (4, "e")]
+
+
+def test_sync_waits_for_queued_writes(writes):
+    committer, pool = writes
+    committer.execute("INSERT INTO t (k, v) VALUES (?, ?)", (1, "a"))
+    assert committer.sync(5)
+    assert rows(pool) == [(1, "a")]
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nvs_TicTacToeBOT as core
+
+
+PLAYER_X = 40_000_001
+PLAYER_O = 40_000_002
+
+
+@pytest.fixture
+def db(tmp_path):
+    core.DB_POOL.close_all()
+    core.DB_POOL.path = str(tmp_path / "moves.db")
+    core.init_db()
+    yield
+    core.flush_games()
+    core.DB_POOL.close_all()
+
+
+def play(gid, state, moves, ts=1_700_000_000):
+    for pos in moves:
+        state.play(pos, state.current_player, ts)
+        state.current_player = "O" if state.current_player == "X" else "X"
+        core.record_move(gid, PLAYER_X, 1001, state)
+        ts += 1
+
+
+def reload(gid):
+    # فقط اسنپ‌شات و لاگ حرکت‌ها در دیتابیس؛ کش خالی مثل بعد از راه‌اندازی دوباره
+    core.GAME_CACHE.discard(gid)
+    return core.load_game(gid)[2]
+
+
+def test_winning_move_after_snapshot_loads_as_finished(db):
+    gid = "movelog00001"
+    state = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=gid)
+    core.save_game(gid, PLAYER_X, 1001, state)
+    play(gid, state, [0, 3])
+    core.GAME_CACHE.flush().result()
+    play(gid, state, [1, 4, 2])
+    loaded = reload(gid)
+    assert loaded.board.to_list()[:3] == ["X", "X", "X"]
+    assert loaded.finished and loaded.winner == "X"
+
+
+def test_full_board_after_snapshot_loads_as_draw(db):
+    gid = "movelog00002"
+    state = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=gid)
+    core.save_game(gid, PLAYER_X, 1001, state)
+    play(gid, state, [0, 1, 2])
+    core.GAME_CACHE.flush().result()
+    play(gid, state, [4, 3, 5, 7, 6, 8])
+    loaded = reload(gid)
+    assert loaded.finished and loaded.winner == "draw"
+
+
+def test_unfinished_game_keeps_side_to_move(db):
+    gid = "movelog00003"
+    state = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=gid)
+    core.save_game(gid, PLAYER_X, 1001, state)
+    core.GAME_CACHE.flush().result()
+    play(gid, state, [0, 4, 8])
+    loaded = reload(gid)
+    assert not loaded.finished and loaded.winner is None
+    assert loaded.current_player == "O"
+
+
+def test_player_message_is_saved_onto_the_current_state(db):
+    gid = "movelog00004"
+    state = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=gid)
+    core.save_game(gid, PLAYER_X, 1001, state)
+    # بازی پیش از رسیدن on_done پیام O جلو رفته و شیء وضعیت عوض شده
+    fresh = core.new_game("pvp", PLAYER_X, PLAYER_O, game_id=gid)
+    core.save_game(gid, PLAYER_X, 1001, fresh)
+    play(gid, fresh, [0])
+    core.save_player_message(gid, "O", PLAYER_O, 2002)
+    core.GAME_CACHE.flush().result()
+    loaded = reload(gid)
+    assert loaded.board.to_list()[0] == "X"
+    assert loaded.message_o == (PLAYER_O, 2002)
@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import apihelper
+
+import nvs_TicTacToeBOT as core
+
+
+class RecordingApi:
+    # هر تماس ثبت می‌شود؛ rate_limit تعداد جواب‌های 429 پیش از موفقیت است
+    def __init__(self, rate_limit=0, retry_after=1):
+        self.calls = []
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._ids = iter(range(500, 10_000))
+        self._lock = threading.Lock()
+
+    def _maybe_limit(self, method):
+        with self._lock:
+            self.calls.append((method, time.monotonic()))
+            if self.rate_limit:
+                self.rate_limit -= 1
+                raise apihelper.ApiTelegramException(method, None, {
+                    "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}})
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._maybe_limit("sendMessage")
+        return SimpleNamespace(message_id=next(self._ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self._maybe_limit("editMessageText")
+        self.last_edit = (chat_id, message_id, text)
+        return True
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self._maybe_limit("answerCallbackQuery")
+        return True
+
+
+def outbox(api):
+    return core.Outbox(api, 1000, 1000, 1000, 2)
+
+
+def test_rate_limited_send_waits_retry_after_then_delivers():
+    api = RecordingApi(rate_limit=1, retry_after=1)
+    box = outbox(api)
+    box.start()
+    delivered = []
+    box.send_message(7, "hi", on_done=delivered.append)
+    assert box.wait_idle(5)
+    assert len(delivered) == 1
+    assert box.rate_limited == 1 and box.sent == 1 and box.failed == 0
+    (_, first), (_, second) = api.calls
+    assert second - first >= 0.9
+
+
+def test_queued_edits_of_one_message_coalesce_to_the_latest():
+    api = RecordingApi()
+    box = outbox(api)
+    done = []
+    for i in range(5):
+        box.edit_message_text(f"board {i}", 7, 42, on_done=lambda r, i=i: done.append(i))
+    box.start()
+    assert box.wait_idle(5)
+    assert [m for m, _ in api.calls] == ["editMessageText"]
+    assert api.last_edit == (7, 42, "board 4")
+    assert box.coalesced == 4
+    assert done == [4]
+
+
+def test_edit_with_unchanged_content_is_skipped():
+    api = RecordingApi()
+    box = outbox(api)
+    box.start()
+    box.edit_message_text("board", 7, 42)
+    assert box.wait_idle(5)
+    box.edit_message_text("board", 7, 42)
+    assert box.wait_idle(5)
+    assert len(api.calls) == 1 and box.unchanged == 1
+
+
+def test_callback_answer_does_not_wait_behind_chat_backlog():
+    api = RecordingApi()
+    # چت ۷ فقط یک پیام در ثانیه می‌فرستد؛ جواب callback نباید پشت صف آن بماند
+    box = core.Outbox(api, 1000, 1, 1, 2)
+    for i in range(3):
+        box.send_message(7, f"m{i}")
+    box.answer_callback_query("cb-1", "ok", show_alert=True)
+    box.start()
+    end = time.monotonic() + 5
+    while "answerCallbackQuery" not in [m for m, _ in api.calls] and time.monotonic() < end:
+        time.sleep(0.01)
+    assert [m for m, _ in api.calls][:2].count("answerCallbackQuery") == 1
+    assert box.wait_idle(5)
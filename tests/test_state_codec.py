@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nvs_TicTacToeBOT as core
+
+
+def played(game_id="codec0000001"):
+    state = core.new_game("pvp", 30_000_001, 30_000_002, game_id=game_id)
+    state.set_message("X", 30_000_001, 11)
+    state.play(4, "X", 1_700_000_000)
+    state.current_player = "O"
+    return state
+
+
+def test_packable_state_is_written_as_blob():
+    row = played().to_row(30_000_001, 11, 1_700_000_000)
+    assert row[3] is None and row[4] is not None and row[5] == core.STATE_VERSION
+    restored = core.GameState.from_row("codec0000001", row[3], row[4])
+    assert restored.board.to_list() == played().board.to_list()
+
+
+def test_unpackable_state_falls_back_to_version_zero_json():
+    state = played()
+    # شناسه‌ای که در int64 قالب باینری جا نمی‌شود
+    state.set_message("O", 1 << 70, 12)
+    row = state.to_row(30_000_001, 11, 1_700_000_000)
+    assert row[3] is not None and row[4] is None and row[5] == 0
+    restored = core.GameState.from_row(state.game_id, row[3], row[4])
+    assert restored.board.to_list() == state.board.to_list()
+    assert restored.current_player == "O"
+    assert restored.message_o == (1 << 70, 12)
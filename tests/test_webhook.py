@@ -0,0 +1,78 @@
+import http.client
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nvs_TicTacToeBOT_webhook as webhook
+
+
+UPDATE = json.dumps({"update_id": 1, "message": {
+    "message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"},
+    "from": {"id": 5, "is_bot": False, "first_name": "p"}, "text": "hi"}})
+
+
+@pytest.fixture
+def server():
+    processed = []
+    server = webhook.WebhookServer(host="127.0.0.1", port=0, secret="s3cret", workers=1, process=processed.append)
+    server.start()
+    yield server, processed
+    server.stop()
+
+
+def post(conn, path, body, token="s3cret", headers=None):
+    conn.request("POST", path, body=body, headers={"Content-Type": "application/json",
+                                                    webhook.SECRET_HEADER: token, **(headers or {})})
+    response = conn.getresponse()
+    response.read()
+    return response
+
+
+def wait_processed(processed, count):
+    end = time.monotonic() + 5
+    while len(processed) < count and time.monotonic() < end:
+        time.sleep(0.01)
+    return len(processed)
+
+
+def test_rejected_body_does_not_poison_keepalive_connection(server):
+    server, processed = server
+    conn = http.client.HTTPConnection(*server.address)
+    assert post(conn, webhook.WEBHOOK_PATH, UPDATE, token="wrong").status == 403
+    assert post(conn, "/elsewhere", UPDATE).status == 404
+    assert post(conn, webhook.WEBHOOK_PATH, UPDATE).status == 200
+    assert wait_processed(processed, 1) == 1
+    assert server.received == 1 and server.rejected == 2
+
+
+def test_oversize_body_closes_connection(server):
+    server, processed = server
+    conn = http.client.HTTPConnection(*server.address)
+    response = post(conn, webhook.WEBHOOK_PATH, "x", headers={"Content-Length": str(webhook.WEBHOOK_MAX_BODY + 1)})
+    assert response.status == 400
+    assert response.getheader("Connection") == "close"
+    conn.close()
+    conn = http.client.HTTPConnection(*server.address)
+    assert post(conn, webhook.WEBHOOK_PATH, UPDATE).status == 200
+    assert wait_processed(processed, 1) == 1
+
+
+def test_without_secret_only_loopback_is_bound():
+    server = webhook.WebhookServer(host="0.0.0.0", port=0, secret="", workers=1, process=lambda update: None)
+    try:
+        assert server.address[0] == "127.0.0.1"
+    finally:
+        server.httpd.server_close()
+
+
+def test_with_secret_the_configured_host_is_kept():
+    server = webhook.WebhookServer(host="0.0.0.0", port=0, secret="s3cret", workers=1, process=lambda update: None)
+    try:
+        assert server.address[0] == "0.0.0.0"
+    finally:
+        server.httpd.server_close()